@@ -11,6 +11,9 @@ from logger import Logger
 
 _MEMORY_MAPPED_IMAGE_CACHE_WRITE_LOCK = Lock()
 
+# Save format for storing the decoded pixel data as is - reading requires no decoding
+RAW_IMAGE_FORMAT = 'RAW'
+
 
 class MemoryMapUpdateMode(Enum):
     UPDATE_ON_EVERY_WRITE = 0
@@ -20,7 +23,8 @@ class MemoryMapUpdateMode(Enum):
 class MemoryMappedImageCache(object):
     # A memory mapped image cache to reduce IO open/close operations.
     # Internally keeps an index of filename -> (start_byte, end_byte)
-    # and stores the image data to a memory mapped file.
+    # and stores the image data to a memory mapped file. Images saved with
+    # the RAW_IMAGE_FORMAT are indexed as (start_byte, end_byte, mode, size).
 
     def __init__(self, cache_path, max_mmap_file_size=0, read_only=False, memory_map_update_mode=MemoryMapUpdateMode.UPDATE_ON_EVERY_WRITE, write_to_secondary_file_cache=False):
         # type: (str, int, bool, MemoryMapUpdateMode) -> None
@@ -206,7 +210,11 @@ class MemoryMappedImageCache(object):
                 if not os.path.exists(tmp_cached_img_path) and not os.path.exists(cached_img_path):
                     # Save is a long process and during save the file is not always valid,
                     # use .tmp extension and remove .tmp extension when save is complete
-                    img.save(tmp_cached_img_path, format=save_format)
+                    # The secondary cache holds regular image files - raw pixel data is stored in
+                    # the image's own encoded format (or lossless PNG). The format can't be inferred
+                    # from the .tmp extension so it has to be always given.
+                    secondary_format = format if format is not None and format != RAW_IMAGE_FORMAT else (img.format or 'PNG')
+                    img.save(tmp_cached_img_path, format=secondary_format)
                     os.rename(tmp_cached_img_path, cached_img_path)
 
                 self.secondary_file_cache_index.add(key)
@@ -214,7 +222,15 @@ class MemoryMappedImageCache(object):
                 Logger.instance().warn('Failed to write to secondary file cache: {}'.format(e.message))
                 self.secondary_file_cache_index.remove(key)
         else:
-            img.save(img_bytes, format=format)
+            if format == RAW_IMAGE_FORMAT:
+                # The palette is not part of the raw pixel data
+                if img.mode == 'P':
+                    img = img.convert('RGB')
+
+                img_bytes.write(img.tobytes())
+            else:
+                img.save(img_bytes, format=format)
+
             num_bytes = img_bytes.tell()
             img_bytes.seek(0)
 
@@ -223,7 +239,11 @@ class MemoryMappedImageCache(object):
                 first_byte = self.data_fp.tell()
                 last_byte = first_byte + num_bytes
                 self.data_fp.write(img_bytes.read())
-                self.index[key] = (first_byte, last_byte)
+
+                if format == RAW_IMAGE_FORMAT:
+                    self.index[key] = (first_byte, last_byte, img.mode, img.size)
+                else:
+                    self.index[key] = (first_byte, last_byte)
 
                 if self.memory_map_update_mode == MemoryMapUpdateMode.UPDATE_ON_EVERY_WRITE:
                     self.update_mmap_fp()
@@ -235,7 +255,12 @@ class MemoryMappedImageCache(object):
         if self.index is not None and key in self.index:
             try:
                 bytes = self.index[key]
-                img = Image.open(BytesIO(self.data_mm_fp[bytes[0]:bytes[1]]))
+
+                # Raw pixel data can be used as is, otherwise decode
+                if len(bytes) == 4:
+                    img = Image.frombuffer(bytes[2], bytes[3], self.data_mm_fp[bytes[0]:bytes[1]], 'raw', bytes[2], 0, 1)
+                else:
+                    img = Image.open(BytesIO(self.data_mm_fp[bytes[0]:bytes[1]]))
 
                 # Fix the filename of the PIL Image to match the key when reading from binary blob,
                 # otherwise the filename will be empty/None
@@ -0,0 +1,130 @@
+import os
+import threading
+import Queue
+
+import h5py
+import keras.backend as K
+
+from keras import __version__ as keras_version
+from keras.callbacks import ModelCheckpoint
+
+from logger import Logger
+
+
+class _WeightSaverModelProxy(object):
+    """
+    Stands in for the model during ModelCheckpoint.on_epoch_end so that the
+    weight saves are routed to the asynchronous writer.
+    """
+
+    def __init__(self, checkpoint, model):
+        self._checkpoint = checkpoint
+        self._model = model
+
+    def save_weights(self, filepath, overwrite=True):
+        self._checkpoint.save_weights_async(self._model, filepath)
+
+    def save(self, filepath, overwrite=True, include_optimizer=True):
+        self._model.save(filepath, overwrite=overwrite, include_optimizer=include_optimizer)
+
+
+class AsyncModelCheckpoint(ModelCheckpoint):
+    """
+    ModelCheckpoint that writes the weights to disk in a background thread. The weights
+    are copied to host memory with a single session run on the training thread and the
+    training continues while the HDF5 file is being written. The file layout is the same
+    as with Model.save_weights. Full model saves (save_weights_only=False) are synchronous.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncModelCheckpoint, self).__init__(*args, **kwargs)
+
+        # At most one pending save - if the disk can't keep up, the training waits
+        self._save_queue = Queue.Queue(maxsize=1)
+        self._writer_thread = None
+
+        # List of (layer name, weight names, weights) - built once on the first save
+        self._save_plan = None
+
+        if not self.save_weights_only:
+            Logger.instance().warn('Asynchronous model checkpoint is only asynchronous with save_weights_only, full model saves are synchronous')
+
+    def on_train_begin(self, logs=None):
+        if self._writer_thread is None:
+            self._writer_thread = threading.Thread(target=self._writer_loop)
+            self._writer_thread.daemon = True
+            self._writer_thread.start()
+
+    def on_train_end(self, logs=None):
+        self.close()
+
+    def on_epoch_end(self, epoch, logs=None):
+        model = self.model
+        self.model = _WeightSaverModelProxy(self, model)
+
+        try:
+            super(AsyncModelCheckpoint, self).on_epoch_end(epoch, logs)
+        finally:
+            self.model = model
+
+    def save_weights_async(self, model, filepath):
+        if self._save_plan is None:
+            self._save_plan = []
+
+            for layer in model.layers:
+                weight_names = [str(w.name) if hasattr(w, 'name') and w.name else 'param_' + str(i) for i, w in enumerate(layer.weights)]
+                self._save_plan.append((layer.name, weight_names, layer.weights))
+
+        weights = [w for _, _, layer_weights in self._save_plan for w in layer_weights]
+        weight_values = K.batch_get_value(weights)
+
+        if self._writer_thread is None:
+            self._write_weights(filepath, weight_values)
+        else:
+            self._save_queue.put((filepath, weight_values))
+
+    def close(self):
+        # Wait for the pending save to complete and stop the writer
+        if self._writer_thread is not None:
+            self._save_queue.put(None)
+            self._writer_thread.join()
+            self._writer_thread = None
+
+    def _writer_loop(self):
+        while True:
+            item = self._save_queue.get()
+
+            if item is None:
+                break
+
+            filepath, weight_values = item
+
+            try:
+                self._write_weights(filepath, weight_values)
+            except Exception as e:
+                Logger.instance().warn('Failed to save weights to: {}, error: {}'.format(filepath, e))
+
+    def _write_weights(self, filepath, weight_values):
+        # Write to a temporary file first, so that a crash during the write doesn't leave a corrupted checkpoint
+        tmp_filepath = filepath + '.tmp'
+        weight_values = iter(weight_values)
+
+        with h5py.File(tmp_filepath, 'w') as f:
+            f.attrs['layer_names'] = [layer_name.encode('utf8') for layer_name, _, _ in self._save_plan]
+            f.attrs['backend'] = K.backend().encode('utf8')
+            f.attrs['keras_version'] = str(keras_version).encode('utf8')
+
+            for layer_name, weight_names, _ in self._save_plan:
+                g = f.create_group(layer_name)
+                g.attrs['weight_names'] = [weight_name.encode('utf8') for weight_name in weight_names]
+
+                for weight_name in weight_names:
+                    val = next(weight_values)
+                    param_dset = g.create_dataset(weight_name, val.shape, dtype=val.dtype)
+
+                    if not val.shape:
+                        param_dset[()] = val
+                    else:
+                        param_dset[:] = val
+
+        os.rename(tmp_filepath, filepath)
@@ -5,6 +5,7 @@ import os
 import re
 import multiprocessing
 
+from multiprocessing.pool import ThreadPool
 from enum import Enum
 from PIL import Image
 from tarfile import TarInfo, TarFile
@@ -13,6 +14,16 @@ from io import BytesIO
 
 from abc import ABCMeta, abstractmethod, abstractproperty
 
+# scandir returns the file type with the directory entry so walking a directory doesn't
+# need a stat per file - it's in the standard library from Python 3.5 onwards
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 ##############################################
 # IMAGE FILE
@@ -267,6 +278,13 @@ class ImageSetSharedResources(object):
 
 class ImageSet(object):
 
+    # Compiled image file name regexes by the extension string
+    _image_file_regexes = dict()
+
+    # Relative image paths by archive folder path - the training and validation sets
+    # are built from the same folders, so each folder is walked only once per process
+    _archive_image_paths = dict()
+
     def __init__(self, name, path_to_archive, file_list=None, mode='r'):
         # type: (str, str, list[str], str) -> None
 
@@ -311,10 +329,7 @@ class ImageSet(object):
                     self._image_files.append(img_file)
                     self._file_name_to_image_file[file_name] = img_file
             else:
-                image_paths = ImageSet.list_pictures(path_to_archive)
-
-                # Remove the shared part of the path - also: filter hidden files and non-files
-                image_paths = [os.path.relpath(p, start=self.path_to_archive) for p in image_paths if os.path.isfile(p) and not os.path.basename(p).startswith('.')]
+                image_paths = ImageSet._get_archive_image_paths(path_to_archive)
 
                 # Create the shared resources
                 self._image_set_shared_resources = ImageSetSharedResources(path_to_archive=self.path_to_archive, tar_file=None, tar_read_lock=None)
@@ -361,13 +376,65 @@ class ImageSet(object):
 
     @staticmethod
     def list_pictures(directory, ext='jpg|jpeg|bmp|png'):
-        return [os.path.join(root, f)
-                for root, _, files in os.walk(directory) for f in files
-                if ImageSet.is_image_file(f, ext=ext)]
+        # type: (str, str) -> list[str]
+
+        """
+        Recursively lists the image files under the directory. Only regular files
+        are returned.
+
+        # Arguments
+            :param directory: path to the directory
+            :param ext: accepted file extensions separated by '|'
+        # Returns
+            :return: a list of image file paths
+        """
+        image_file_regex = ImageSet._get_image_file_regex(ext)
+
+        if scandir is None:
+            return [os.path.join(root, f)
+                    for root, _, files in os.walk(directory) for f in files
+                    if image_file_regex.match(f) and os.path.isfile(os.path.join(root, f))]
+
+        image_paths = []
+        directories = [directory]
+
+        # Like os.walk, don't descend into symlinked directories
+        while len(directories) > 0:
+            for entry in scandir(directories.pop()):
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file() and image_file_regex.match(entry.name):
+                    image_paths.append(entry.path)
+
+        return image_paths
+
+    @staticmethod
+    def _get_archive_image_paths(path_to_archive):
+        # type: (str) -> list[str]
+        image_paths = ImageSet._archive_image_paths.get(path_to_archive)
+
+        if image_paths is None:
+            image_paths = ImageSet.list_pictures(path_to_archive)
+
+            # Remove the shared part of the path - also: filter hidden files, list_pictures only returns files
+            image_paths = [os.path.relpath(p, start=path_to_archive) for p in image_paths if not os.path.basename(p).startswith('.')]
+            ImageSet._archive_image_paths[path_to_archive] = image_paths
+
+        return image_paths
 
     @staticmethod
     def is_image_file(f, ext='jpg|jpeg|bmp|png'):
-        return re.match(r'([\w]+\.(?:' + ext + '))', f)
+        return ImageSet._get_image_file_regex(ext).match(f)
+
+    @staticmethod
+    def _get_image_file_regex(ext):
+        image_file_regex = ImageSet._image_file_regexes.get(ext)
+
+        if image_file_regex is None:
+            image_file_regex = re.compile(r'([\w]+\.(?:' + ext + '))')
+            ImageSet._image_file_regexes[ext] = image_file_regex
+
+        return image_file_regex
 
     @property
     def image_files(self):
@@ -459,8 +526,18 @@ class LabeledImageDataSet(DataSet):
         """
         super(LabeledImageDataSet, self).__init__(name=name)
 
-        self._photo_image_set = ImageSet(self.name + '_photos', path_to_photo_archive, photo_file_list)
-        self._mask_image_set = ImageSet(self.name + '_masks', path_to_mask_archive, mask_file_list)
+        # The photo and mask archives are independent - scan them concurrently
+        pool = ThreadPool(processes=2)
+
+        try:
+            photo_image_set = pool.apply_async(ImageSet, (self.name + '_photos', path_to_photo_archive, photo_file_list))
+            mask_image_set = pool.apply_async(ImageSet, (self.name + '_masks', path_to_mask_archive, mask_file_list))
+            self._photo_image_set = photo_image_set.get()
+            self._mask_image_set = mask_image_set.get()
+        finally:
+            pool.close()
+            pool.join()
+
         self._material_samples = material_samples
 
         # Make sure the photos and masks are organized in the same way
@@ -0,0 +1,105 @@
+# coding=utf-8
+
+import argparse
+import json
+import os
+import time
+
+from keras import backend as K
+
+from utils import dataset_utils
+from models import get_model
+
+# GLOBALS
+
+CONFIG = None
+
+
+def read_config_json(path):
+    with open(path) as f:
+        data = f.read()
+        return json.loads(data)
+
+
+def get_config_value(key):
+    global CONFIG
+    return CONFIG[key] if key in CONFIG else None
+
+
+def get_latest_weights_file_path(weights_folder_path):
+    weight_files = dataset_utils.get_files(weights_folder_path)
+
+    if len(weight_files) > 0:
+        weight_files.sort()
+        weight_file = weight_files[-1]
+        return os.path.join(weights_folder_path, weight_file)
+
+    return None
+
+
+def main():
+
+    # Construct the argument parser and parse arguments
+    ap = argparse.ArgumentParser(description='Exports a trained model with weights as a SavedModel for inference')
+    ap.add_argument('-m', '--model', required=True, type=str, help='Name of the neural network model to use')
+    ap.add_argument('-c', '--config', required=True, type=str, help='Path to trainer configuration JSON file')
+    ap.add_argument('-w', '--weights', required=True, type=str, help='Path to weights directory or weights file')
+    ap.add_argument('-o', '--output', required=True, type=str, help='Path to the SavedModel directory to create')
+    ap.add_argument('--fp16', required=False, type=bool, default=False, help='Export the model in float16')
+    args = vars(ap.parse_args())
+
+    model_name = args['model']
+    config_file_path = args['config']
+    weights_path = args['weights']
+    output_path = args['output']
+    use_fp16 = args['fp16']
+
+    # Read the configuration file
+    global CONFIG
+    print 'Loading the configuration from file: {}'.format(config_file_path)
+    CONFIG = read_config_json(config_file_path)
+
+    # Load the material class information
+    material_class_information_path = get_config_value('path_to_material_class_file')
+    print 'Loading the material class information from file: {}'.format(material_class_information_path)
+    material_class_information = dataset_utils.load_material_class_information(material_class_information_path)
+    print 'Loaded {} material classes'.format(len(material_class_information))
+
+    # Build the inference graph: the learning phase is fixed so dropout and
+    # batch normalization are baked in in inference mode
+    K.set_learning_phase(0)
+
+    if use_fp16:
+        print 'Using float16 for the exported model'
+        K.set_floatx('float16')
+        K.set_epsilon(1e-4)
+
+    num_classes = len(material_class_information)
+    input_shape = get_config_value('input_shape')
+
+    print 'Loading model {} instance with input shape: {}, num classes: {}'.format(model_name, input_shape, num_classes)
+    model_wrapper = get_model(model_name, input_shape, num_classes)
+    model = model_wrapper.model
+
+    # Load either provided weights or try to find the newest weights from the
+    # checkpoint path
+    if os.path.isdir(weights_path):
+        print 'Searching for most recent weights in: {}'.format(weights_path)
+        weights_path = get_latest_weights_file_path(weights_path)
+
+    print 'Loading weights from: {}'.format(weights_path)
+    model.load_weights(weights_path)
+
+    print 'Exporting SavedModel to: {}'.format(output_path)
+    stime = time.time()
+
+    K.tf.saved_model.simple_save(K.get_session(),
+                                 output_path,
+                                 inputs={'input': model.input},
+                                 outputs={'output': model.output})
+
+    print 'Export finished in time: {} s'.format(time.time() - stime)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,7 @@ import random
 import os
 import numpy as np
 
-from cache import MemoryMappedImageCache, MemoryMapUpdateMode
+from cache import MemoryMappedImageCache, MemoryMapUpdateMode, RAW_IMAGE_FORMAT
 
 from enum import Enum
 from abc import ABCMeta, abstractmethod, abstractproperty
@@ -371,6 +371,11 @@ class DataGenerator(object):
             self.per_channel_stddev = np.array(dataset_utils.calculate_per_channel_stddev(self.get_all_photos(), self.per_channel_mean))
             self.logger.log('DataGenerator: Using per-channel stddev: {}'.format(list(self.per_channel_stddev)))
 
+        # The batch normalization scale and offset are constant - compute them once instead of for every batch
+        self._normalization_scale, self._normalization_offset = image_utils.get_normalization_scale_and_offset(
+            per_channel_mean=self.per_channel_mean if self.use_per_channel_mean_normalization else None,
+            per_channel_stddev=self.per_channel_stddev if self.use_per_channel_stddev_normalization else None)
+
         # Use per-channel mean but in range [0, 255] if nothing else is given.
         # The normalization is done to the whole batch after transformations so
         # the images are not in range [-1,1] before transformations.
@@ -458,7 +463,7 @@ class DataGenerator(object):
         if not self.using_resized_image_cache:
             return
 
-        save_format = img.format
+        save_format = RAW_IMAGE_FORMAT if settings.RESIZED_IMAGE_CACHE_SAVE_RAW else img.format
 
         if save_format is None:
             cached_img_name = os.path.splitext(os.path.basename(cache_key))
@@ -722,50 +727,22 @@ class DataGenerator(object):
             :return: The parameter batch normalized with the given values
         """
 
-        # Make sure the batch data type is correct
-        batch = batch.astype(np.float32)
-
-        if np.min(batch) < 0 or np.max(batch) > 255:
-            raise ValueError('Batch image values are not between [0, 255], got [{}, {}]'.format(np.min(batch), np.max(batch)))
+        if self.use_per_channel_mean_normalization and self.per_channel_mean is None:
+            raise ValueError('Use per-channel mean normalization is true, but per-channel mean is None')
 
-        # Map the values from [0, 255] to [-1, 1]
-        batch /= 255.0
-        batch -= 0.5
-        batch *= 2.0
+        if self.use_per_channel_stddev_normalization and self.per_channel_stddev is None:
+            raise ValueError('Use per-channel stddev normalization is true, but per-channel stddev is None')
 
-        # Subtract the per-channel-mean from the batch to "center" the data.
-        if self.use_per_channel_mean_normalization:
-            if self.per_channel_mean is None:
-                raise ValueError('Use per-channel mean normalization is true, but per-channel mean is None')
+        # Make sure the batch data type is correct, the batches are created for this call so modify in-place
+        batch = batch.astype(np.float32, copy=False)
 
-            _per_channel_mean = np.array(self.per_channel_mean).astype(np.float32)
+        if np.min(batch) < 0 or np.max(batch) > 255:
+            raise ValueError('Batch image values are not between [0, 255], got [{}, {}]'.format(np.min(batch), np.max(batch)))
 
-            # Per channel mean is in range [-1,1]
-            if (_per_channel_mean >= -1.0 - 1e-7).all() and (_per_channel_mean <= 1.0 + 1e-7).all():
-                batch -= _per_channel_mean
-            # Per channel mean is in range [0, 255]
-            elif (_per_channel_mean >= 0.0).all() and (_per_channel_mean <= 255.0).all():
-                batch -= image_utils.np_from_255_to_normalized(_per_channel_mean)
-            else:
-                raise ValueError('Per channel mean is in unknown range: {}'.format(_per_channel_mean))
-
-        # Additionally, you ideally would like to divide by the sttdev of
-        # that feature or pixel as well if you want to normalize each feature
-        # value to a z-score.
-        if self.use_per_channel_stddev_normalization:
-            if self.per_channel_stddev is None:
-                raise ValueError('Use per-channel stddev normalization is true, but per-channel stddev is None')
-
-            _per_channel_stddev = np.array(self.per_channel_stddev).astype(np.float32)
-
-            # Per channel stddev is in range [-1, 1]
-            if (_per_channel_stddev >= -1.0 - 1e-7).all() and (_per_channel_stddev <= 1.0 + 1e-7).all():
-                batch /= _per_channel_stddev
-            # Per channel stddev is in range [0, 255]
-            elif (_per_channel_stddev >= 0.0).all() and (_per_channel_stddev <= 255.0).all():
-                batch /= image_utils.np_from_255_to_normalized(_per_channel_stddev)
-            else:
-                raise ValueError('Per-channel stddev is in unknown range: {}'.format(_per_channel_stddev))
+        # Map the values from [0, 255] to [-1, 1], subtract the per-channel mean to "center" the data
+        # and divide by the per-channel stddev to get z-scores: all folded into a single scale and offset
+        batch *= self._normalization_scale
+        batch += self._normalization_offset
 
         return batch
 
@@ -860,8 +837,7 @@ class DataGenerator(object):
 
         # If not applying any noise - return the same images
         if not self.data_augmentation_params.using_mean_teacher_noise:
-            X_teacher = [img_to_array(img) for img in X]
-            X_teacher = np.asarray(X_teacher, dtype=dtype)
+            X_teacher = image_utils.imgs_to_array_batch(X, dtype=dtype)
             return X_teacher
 
         # Apply noise transformations individually to each image
@@ -877,8 +853,7 @@ class DataGenerator(object):
                 delayed(pickle_method)(self, '_apply_mean_teacher_noise_to_image', img=img) for img in X)
 
         # Transform from PIL to Numpy
-        X_teacher = [img_to_array(img) for img in X_teacher]
-        X_teacher = np.asarray(X_teacher, dtype=dtype)
+        X_teacher = image_utils.imgs_to_array_batch(X_teacher, dtype=dtype)
 
         # Normalize
         X_teacher = self._np_normalize_image_batch(X_teacher)
@@ -1006,6 +981,12 @@ class SegmentationDataGenerator(DataGenerator):
 
                 self.material_r_color_to_material_class[r_color] = material.id
 
+        # Look up table red color -> class idx for index encoding a whole mask with a single gather,
+        # -1 marks red colors that don't belong to any material
+        self._material_r_color_lut = np.full(256, -1, dtype=np.int32)
+
+        for r_color, material_class_id in self.material_r_color_to_material_class.items():
+            self._material_r_color_lut[r_color] = material_class_id
 
         # Use black (background)
         if self.mask_cval is None:
@@ -1023,7 +1004,7 @@ class SegmentationDataGenerator(DataGenerator):
         if class_weights is None:
             raise ValueError('Class weights is None. Use a numpy array of ones instead of None')
 
-        self.class_weights = class_weights
+        self.class_weights = np.asarray(class_weights, dtype=np.float32)
 
         self.logger.log('Use material samples: {}, material sample iteration mode: {}'.format(self.use_material_samples, self.material_sample_iteration_mode))
         self.logger.log('Use selective attention: {}'.format(self.use_selective_attention))
@@ -1725,7 +1706,7 @@ class SegmentationDataGenerator(DataGenerator):
             self.logger.debug_log('Mean Teacher data generation took: {}s'.format(time.time()-stime_t_data))
 
         # Process all the information into numpy arrays
-        X = np.array([img_to_array(img) for img in X], dtype=np.float32)
+        X = image_utils.imgs_to_array_batch(X, dtype=np.float32)
         Y = self._index_encode_batch_masks(Y, num_labeled=len(labeled_batch))
         W = self._create_batch_weights(Y, num_labeled=len(labeled_batch))
 
@@ -1801,10 +1782,11 @@ class SegmentationDataGenerator(DataGenerator):
 
             # For the labeled
             if i < num_labeled:
-                found_material_r_colors = np.unique(np_mask)
+                np_masks[i] = self._material_r_color_lut[np_mask]
 
-                for r_color in found_material_r_colors:
-                    np_masks[i][np_mask == r_color] = self.material_r_color_to_material_class[r_color]
+                if np.any(np_masks[i] < 0):
+                    unknown_r_colors = np.unique(np_mask[np_masks[i] < 0])
+                    raise ValueError('Found red colors that do not belong to any material in mask: {}'.format(list(unknown_r_colors)))
             # For the unlabeled
             else:
                 np_masks[i] = np_mask
@@ -1814,13 +1796,9 @@ class SegmentationDataGenerator(DataGenerator):
     def _create_batch_weights(self, np_masks, num_labeled):
         # type: (np.ndarray, int) -> np.ndarray
 
+        # The labeled weights are a single gather from the class weights, unlabeled weights are ones
         np_weights = np.ones_like(np_masks, dtype=np.float32)
-        np_labeled_weights_view = np_weights[0:num_labeled]
-        np_labeled_masks_view = np_masks[0:num_labeled]
-        unique_class_ids = np.unique(np_labeled_masks_view)
-
-        for class_id in unique_class_ids:
-            np_labeled_weights_view[np_labeled_masks_view == class_id] = self.class_weights[class_id]
+        np_weights[0:num_labeled] = self.class_weights[np_masks[0:num_labeled]]
 
         return np_weights
 
@@ -2217,8 +2195,7 @@ class ClassificationDataGenerator(DataGenerator):
             X_teacher = self._get_mean_teacher_data_from_image_batch(X, self.photo_transform_interpolation_type, dtype=np.float32)
             self.logger.debug_log('Mean Teacher data generation took: {}s'.format(time.time()-stime_t_data))
 
-        X = [img_to_array(img) for img in X]
-        X = np.asarray(X, dtype=np.float32)
+        X = image_utils.imgs_to_array_batch(X, dtype=np.float32)
         Y = np.asarray(Y, dtype=np.float32)
         W = np.asarray(W, dtype=np.float32)
 
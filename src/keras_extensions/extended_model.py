@@ -1276,12 +1276,29 @@ class ExtendedModel(Model):
 
         self.logger.log('Evaluation took: {} s'.format(time.time()-eval_s_time))
 
-        if not isinstance(outs, list):
+        return self.average_evaluation_outs(all_outs, batch_sizes)
+
+    def average_evaluation_outs(self, all_outs, batch_sizes):
+        # type: (list, list[int]) -> list
+
+        """
+        Aggregates the per batch outputs of test_on_batch into the evaluation results.
+        Streaming metrics use the last value, confusion matrices are summed across
+        batches and all the other metrics are averaged weighted by the batch sizes.
+
+        # Arguments
+            all_outs: list of test_on_batch outputs, one per batch
+            batch_sizes: list of batch sizes, one per batch
+
+        # Returns
+            Scalar test loss or list of scalars in the order of `model.metrics_names`
+        """
+        if not isinstance(all_outs[-1], list):
             return np.average(np.asarray(all_outs), weights=batch_sizes)
         else:
             averages = []
 
-            for i in range(len(outs)):
+            for i in range(len(all_outs[-1])):
                 per_batch_metrics = np.array([out[i] for out in all_outs])
                 metric_name = self.metrics_names[i]
 
@@ -1,10 +1,44 @@
 # coding=utf-8
 
 from keras import backend as K
-from keras.optimizers import Optimizer
+from keras.optimizers import Optimizer, clip_norm
 from keras.legacy import interfaces
 
 
+def _get_loss_scaled_gradients(optimizer, loss, params):
+    """
+    Computes the gradients of the loss multiplied by the optimizer's static loss scale and
+    divides them back before clipping. With float16 compute (settings.USE_AUTO_MIXED_PRECISION)
+    this keeps small gradients from flushing to zero.
+
+    # Arguments
+        :param optimizer: the optimizer, must have a loss_scale attribute
+        :param loss: the loss tensor
+        :param params: the parameters to compute the gradients for
+    # Returns
+        :return: list of gradient tensors
+    """
+    if optimizer.loss_scale == 1.0:
+        return Optimizer.get_gradients(optimizer, loss, params)
+
+    grads = K.gradients(loss * optimizer.loss_scale, params)
+
+    if None in grads:
+        raise ValueError('An operation has `None` for gradient. '
+                         'Please make sure that all of your ops have a '
+                         'gradient defined (i.e. are differentiable).')
+
+    grads = [g / optimizer.loss_scale for g in grads]
+
+    if hasattr(optimizer, 'clipnorm') and optimizer.clipnorm > 0:
+        norm = K.sqrt(sum([K.sum(K.square(g)) for g in grads]))
+        grads = [clip_norm(g, optimizer.clipnorm, norm) for g in grads]
+    if hasattr(optimizer, 'clipvalue') and optimizer.clipvalue > 0:
+        grads = [K.clip(g, -optimizer.clipvalue, optimizer.clipvalue) for g in grads]
+
+    return grads
+
+
 class SGD(Optimizer):
     """Stochastic gradient descent optimizer.
 
@@ -17,10 +51,11 @@ class SGD(Optimizer):
         decay: float >= 0. Learning rate decay over each update.
         nesterov: boolean. Whether to apply Nesterov momentum.
         lr_scalers: dictionary for lr scaling (layer idx -> lr scaling factor).
+        loss_scale: float >= 1. Static loss scale for float16 gradients.
     """
 
     def __init__(self, lr=0.01, momentum=0., decay=0.,
-                 nesterov=False, lr_scalers={}, **kwargs):
+                 nesterov=False, lr_scalers={}, loss_scale=1.0, **kwargs):
         super(SGD, self).__init__(**kwargs)
         with K.name_scope(self.__class__.__name__):
             self.iterations = K.variable(0., name='iterations')
@@ -30,6 +65,10 @@ class SGD(Optimizer):
         self.initial_decay = decay
         self.nesterov = nesterov
         self.lr_scalers = lr_scalers
+        self.loss_scale = float(loss_scale)
+
+    def get_gradients(self, loss, params):
+        return _get_loss_scaled_gradients(self, loss, params)
 
     @interfaces.legacy_get_updates_support
     def get_updates(self, loss, params):
@@ -71,7 +110,8 @@ class SGD(Optimizer):
                   'momentum': float(K.get_value(self.momentum)),
                   'decay': float(K.get_value(self.decay)),
                   'nesterov': self.nesterov,
-                  'lr_scalers': self.lr_scalers}
+                  'lr_scalers': self.lr_scalers,
+                  'loss_scale': self.loss_scale}
         base_config = super(SGD, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
@@ -91,6 +131,7 @@ class Adam(Optimizer):
         amsgrad: boolean. Whether to apply the AMSGrad variant of this
             algorithm from the paper "On the Convergence of Adam and
             Beyond".
+        loss_scale: float >= 1. Static loss scale for float16 gradients.
 
     # References
         - [Adam - A Method for Stochastic Optimization](http://arxiv.org/abs/1412.6980v8)
@@ -98,7 +139,7 @@ class Adam(Optimizer):
     """
 
     def __init__(self, lr=0.001, beta_1=0.9, beta_2=0.999,
-                 epsilon=1e-8, decay=0., lr_scalers={}, amsgrad=False, **kwargs):
+                 epsilon=1e-8, decay=0., lr_scalers={}, amsgrad=False, loss_scale=1.0, **kwargs):
         super(Adam, self).__init__(**kwargs)
         with K.name_scope(self.__class__.__name__):
             self.iterations = K.variable(0, name='iterations')
@@ -112,6 +153,10 @@ class Adam(Optimizer):
         self.initial_decay = decay
         self.amsgrad = amsgrad
         self.lr_scalers = lr_scalers
+        self.loss_scale = float(loss_scale)
+
+    def get_gradients(self, loss, params):
+        return _get_loss_scaled_gradients(self, loss, params)
 
     @interfaces.legacy_get_updates_support
     def get_updates(self, loss, params):
@@ -168,6 +213,7 @@ class Adam(Optimizer):
                   'decay': float(K.get_value(self.decay)),
                   'epsilon': self.epsilon,
                   'amsgrad': self.amsgrad,
-                  'lr_scalers': self.lr_scalers}
+                  'lr_scalers': self.lr_scalers,
+                  'loss_scale': self.loss_scale}
         base_config = super(Adam, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
@@ -2,6 +2,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import ctypes
 import multiprocessing
 import random
 import threading
@@ -12,8 +13,6 @@ import traceback
 import time
 
 from abc import abstractmethod, ABCMeta
-from multiprocessing.pool import ThreadPool
-from contextlib import closing
 
 import numpy as np
 
@@ -63,6 +62,10 @@ def init_pool(uuid, seed, seqs):
     is_daemon = multiprocessing.current_process().daemon
     Logger.instance().log('Hello from process: {} for uuid: {}, daemon: {}'.format(pid, uuid, is_daemon))
 
+    # The data generation is pure numpy/PIL - hide the GPUs so nothing in the worker
+    # can create a CUDA context of its own or reserve GPU memory
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
     # Initialize the random seed
     random.seed(seed)
     np.random.seed(seed)
@@ -71,6 +74,206 @@ def init_pool(uuid, seed, seqs):
     _SHARED_SEQUENCES = seqs
 
 
+def worker_loop(uuid, seed, seqs, index_queue, result_queue, is_process, shared_memory_pool=None):
+    # type: (int, int, dict, queue.Queue, queue.Queue, bool, SharedMemoryPool) -> None
+
+    """Persistent worker of the OrderedEnqueuer. Pulls tasks from its own index queue
+    and pushes the generated batches to the shared result queue until it receives None.
+
+    # Arguments
+        uuid: uuid of the enqueuer
+        seed: random seed for the worker
+        seqs: the shared sequences at the time of the worker creation
+        index_queue: queue of `(seq_no, e_idx, b_idx)` tasks
+        result_queue: queue (or ResultBuffer) of `(seq_no, success, value)` results
+        is_process: is the worker running in its own process
+        shared_memory_pool: if given the batches are passed to the parent through shared memory
+    """
+    # Threads share the globals of the parent, only processes need to be initialized
+    if is_process:
+        init_pool(uuid, seed, seqs)
+
+    while True:
+        task = index_queue.get(block=True)
+
+        # Poison pill - we are done
+        if task is None:
+            break
+
+        seq_no, e_idx, b_idx = task
+
+        try:
+            batch = get_index(uuid, e_idx, b_idx)
+
+            if shared_memory_pool is not None:
+                batch = shared_memory_pool.write(batch)
+
+            result_queue.put((seq_no, True, batch))
+        except Exception as e:
+            # Can't pickle tracebacks.
+            # As a compromise, print the traceback and pickle None instead.
+            traceback.print_exc()
+            setattr(e, '__traceback__', None)
+            result_queue.put((seq_no, False, e))
+
+
+class SharedArray(object):
+    """Describes a numpy array stored in a shared memory slot."""
+
+    def __init__(self, offset, shape, dtype):
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+
+class SharedMemoryBatch(object):
+    """A batch whose numpy arrays have been replaced by SharedArrays in a shared memory slot."""
+
+    def __init__(self, slot, value):
+        self.slot = slot
+        self.value = value
+
+
+class SharedMemoryPool(object):
+    """A fixed set of shared memory slots for passing batches from worker processes
+    to the parent without pickling the array data through a pipe. Only the small
+    SharedMemoryBatch descriptor goes through the result queue.
+
+    The pool must be created before the worker processes are forked.
+
+    # Arguments
+        num_slots: number of slots
+        slot_size: size of a single slot in bytes
+    """
+
+    _ALIGNMENT = 64
+
+    def __init__(self, num_slots, slot_size):
+        self.slot_size = slot_size
+        self.slots = [multiprocessing.RawArray(ctypes.c_uint8, slot_size) for _ in range(num_slots)]
+        self.free_slots = multiprocessing.Queue()
+        self._slot_arrays = None
+
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+
+    def _get_slot_array(self, slot):
+        # type: (int) -> np.ndarray
+        # Lazily create the numpy views in each process
+        if self._slot_arrays is None:
+            self._slot_arrays = [np.ctypeslib.as_array(s) for s in self.slots]
+
+        return self._slot_arrays[slot]
+
+    def _encode(self, value, slot_array, offset):
+        if isinstance(value, np.ndarray):
+            if value.dtype.hasobject:
+                raise ValueError('Object arrays cannot be placed in shared memory')
+
+            offset = int(np.ceil(offset / float(self._ALIGNMENT))) * self._ALIGNMENT
+            end = offset + value.nbytes
+
+            if end > self.slot_size:
+                raise ValueError('Batch does not fit in a shared memory slot of {} bytes'.format(self.slot_size))
+
+            slot_array[offset:end].view(value.dtype).reshape(value.shape)[...] = value
+            return SharedArray(offset=offset, shape=value.shape, dtype=value.dtype), end
+
+        if isinstance(value, (list, tuple)):
+            encoded = []
+
+            for v in value:
+                e, offset = self._encode(v, slot_array, offset)
+                encoded.append(e)
+
+            return type(value)(encoded), offset
+
+        return value, offset
+
+    def _decode(self, value, slot_array):
+        if isinstance(value, SharedArray):
+            end = value.offset + int(np.prod(value.shape)) * value.dtype.itemsize
+            return slot_array[value.offset:end].view(value.dtype).reshape(value.shape)
+
+        if isinstance(value, (list, tuple)):
+            return type(value)([self._decode(v, slot_array) for v in value])
+
+        return value
+
+    def write(self, batch):
+        # type: (object) -> object
+
+        """Worker side: copies the arrays of the batch to a free slot. Blocks until a slot is free.
+
+        # Arguments
+            batch: the batch generated by the sequence
+        # Returns
+            A SharedMemoryBatch or the original batch if it cannot be placed in shared memory
+        """
+        slot = self.free_slots.get(block=True)
+
+        try:
+            value, _ = self._encode(batch, self._get_slot_array(slot), 0)
+        except ValueError:
+            self.free_slots.put(slot)
+            return batch
+
+        return SharedMemoryBatch(slot=slot, value=value)
+
+    def read(self, shared_batch):
+        # type: (SharedMemoryBatch) -> object
+
+        """Parent side: rebuilds the batch as numpy views on the slot. The slot must
+        not be released before the views are no longer used.
+
+        # Arguments
+            shared_batch: the SharedMemoryBatch received from the worker
+        # Returns
+            The batch
+        """
+        return self._decode(shared_batch.value, self._get_slot_array(shared_batch.slot))
+
+    def release(self, slot):
+        # type: (int) -> None
+        self.free_slots.put(slot)
+
+
+class ResultBuffer(object):
+    """Buffers the worker results by their sequence number. Producers only hold the
+    condition lock for a dictionary insert, and the single consumer waits on the
+    condition for the exact sequence number it needs next.
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.condition = threading.Condition()
+
+    def put(self, result):
+        # type: (tuple) -> None
+        seq_no, success, value = result
+
+        with self.condition:
+            self.results[seq_no] = (success, value)
+            self.condition.notify()
+
+    def pop(self, seq_no, timeout):
+        # type: (int, float) -> tuple
+
+        """Waits for the result with the given sequence number.
+
+        # Arguments
+            seq_no: sequence number of the task
+            timeout: maximum time to wait for the result
+        # Returns
+            Tuple `(success, value)` or None if the result did not arrive in time
+        """
+        with self.condition:
+            if seq_no not in self.results:
+                self.condition.wait(timeout)
+
+            return self.results.pop(seq_no, None)
+
+
 ###############################################
 # SEQUENCE
 ###############################################
@@ -195,6 +398,11 @@ class OrderedEnqueuer(SequenceEnqueuer):
 
     Used in `fit_generator`, `evaluate_generator`, `predict_generator`.
 
+    The batches are generated by persistent workers (processes or threads) which each
+    consume their own queue of batch indices. The indices are distributed round-robin
+    and every task carries a running sequence number, which is used to return the
+    batches in the submission order.
+
     # Arguments
         sequence: A `keras.utils.data_utils.Sequence` object.
         use_multiprocessing: use multiprocessing if True, otherwise threading
@@ -226,7 +434,14 @@ class OrderedEnqueuer(SequenceEnqueuer):
 
         self.shuffle = shuffle
         self.workers = 0
-        self.executor_fn = None
+        self.worker_threads = []
+        self.index_queues = []
+        self.result_queue = None
+        self.result_buffer = None
+        self.result_thread = None
+        self.shared_memory_pool = None
+        self.shared_memory_slot_in_use = None
+        self.next_submit_seq_no = 0
         self.queue = None
         self.run_thread = None
         self.stop_signal = None
@@ -235,9 +450,11 @@ class OrderedEnqueuer(SequenceEnqueuer):
         self._logger = None
         self.paused = False
         self.pause_sleep_time = 1.00
+        self.result_wait_time = 1.00
         self.last_queue_size_report_time = 0.0
         self.seed = seed
         self.steps_per_epoch = len(self.sequence)
+        self.random_state = np.random.RandomState(seed)
 
         if seed is not None:
             random.seed(seed)
@@ -257,33 +474,79 @@ class OrderedEnqueuer(SequenceEnqueuer):
         # Initialize the pause state
         self.paused = start_paused
 
-        if self.use_multiprocessing:
-            self.executor_fn = lambda seqs: multiprocessing.Pool(workers,
-                                                                 initializer=init_pool,
-                                                                 initargs=(self.uid, self.seed, seqs,))
-        else:
-            # We do not need the init since it's threads.
-            self.executor_fn = ThreadPool(workers)
-
         self.workers = workers
         self.last_queue_size_report_time = time.time()
         self.queue = queue.Queue(max_queue_size)
+        self.result_buffer = ResultBuffer()
+        self.next_submit_seq_no = 0
         self.stop_signal = threading.Event()
+
+        global _SHARED_SEQUENCES
+        _SHARED_SEQUENCES[self.uid] = self.sequence
+
+        # Processes send their results through a pipe which is drained by a reader thread,
+        # so the results are unpickled while the consumer is busy. Threads write directly
+        # to the result buffer.
+        if self.use_multiprocessing:
+            self.result_queue = multiprocessing.Queue()
+            self.index_queues = [multiprocessing.Queue() for _ in range(workers)]
+
+            # At most max_queue_size + 1 batches are in flight while the consumer waits for the next one
+            if settings.ENQUEUER_SHARED_MEMORY_SLOT_SIZE is not None:
+                self.shared_memory_pool = SharedMemoryPool(num_slots=max_queue_size + 2,
+                                                           slot_size=settings.ENQUEUER_SHARED_MEMORY_SLOT_SIZE)
+
+            self.result_thread = threading.Thread(target=self._read_results)
+            self.result_thread.daemon = True
+            self.result_thread.start()
+        else:
+            self.result_queue = self.result_buffer
+            self.index_queues = [queue.Queue() for _ in range(workers)]
+
+        for index_queue in self.index_queues:
+            args = (self.uid, self.seed, _SHARED_SEQUENCES, index_queue, self.result_queue, self.use_multiprocessing, self.shared_memory_pool)
+
+            if self.use_multiprocessing:
+                worker = multiprocessing.Process(target=worker_loop, args=args)
+            else:
+                worker = threading.Thread(target=worker_loop, args=args)
+
+            worker.daemon = True
+            worker.start()
+            self.worker_threads.append(worker)
+
         self.run_thread = threading.Thread(target=self._run)
         self.run_thread.daemon = True
         self.run_thread.start()
 
-    def _wait_queue(self):
-        """Wait for the queue to be empty."""
-        while True:
-            time.sleep(0.1)
-            if self.queue.unfinished_tasks == 0 or self.stop_signal.is_set():
-                return
+    def _put_seq_no(self, seq_no):
+        # type: (int) -> bool
+
+        """Blocks until there is room in the queue or the enqueuer is stopped.
+
+        # Arguments
+            seq_no: sequence number of the task
+        # Returns
+            True if the sequence number was queued, False if the enqueuer was stopped
+        """
+        while not self.stop_signal.is_set():
+            try:
+                self.queue.put(seq_no, block=True, timeout=self.result_wait_time)
+                return True
+            except queue.Full:
+                continue
+
+        return False
 
     def _run(self):
-        """Function to submit request to the executor and queue the `Future` objects."""
-        sequence = list(range(len(self.sequence)))
-        self._send_sequence()  # Share the initial sequence
+        """Function to submit the batch indices to the workers and queue their sequence numbers.
+
+        The batches of the next epoch are submitted as soon as all the batches of the
+        current epoch have been submitted, so the queue stays full across epoch boundaries.
+        The bounded queue provides the backpressure.
+        """
+        # Shuffled in-place with the enqueuer's own random state at the beginning of each epoch
+        sequence = np.arange(len(self.sequence), dtype=np.int32)
 
         while True:
             # Prevent useless epochs from running
@@ -293,37 +556,90 @@ class OrderedEnqueuer(SequenceEnqueuer):
 
             if not self.paused:
                 if self.shuffle:
-                    random.shuffle(sequence)
+                    self.random_state.shuffle(sequence)
 
-                with closing(self.executor_fn(_SHARED_SEQUENCES)) as executor:
+                for b_idx in sequence.tolist():
+                    if self.stop_signal.is_set():
+                        return
 
-                    for b_idx in sequence:
-                        if self.stop_signal.is_set():
-                            return
+                    # Reserve the slot in the queue before handing the task to a worker
+                    seq_no = self.next_submit_seq_no
 
-                        self.queue.put(
-                            executor.apply_async(get_index, (self.uid, self.e_idx, b_idx)), block=True)
+                    if not self._put_seq_no(seq_no):
+                        return
 
-                        if settings.QUEUE_SIZE_REPORT_INTERVAL is not None:
-                            if time.time() - self.last_queue_size_report_time > settings.QUEUE_SIZE_REPORT_INTERVAL:
-                                self.last_queue_size_report_time = time.time()
-                                self.logger.log('Queue size: {}'.format(self.queue.qsize()))
+                    self.index_queues[seq_no % self.workers].put((seq_no, self.e_idx, b_idx))
+                    self.next_submit_seq_no += 1
 
-                    # Done with the current epoch, waiting for the final batches
-                    self._wait_queue()
+                    if settings.QUEUE_SIZE_REPORT_INTERVAL is not None:
+                        if time.time() - self.last_queue_size_report_time > settings.QUEUE_SIZE_REPORT_INTERVAL:
+                            self.last_queue_size_report_time = time.time()
+                            self.logger.log('Queue size: {}'.format(self.queue.qsize()))
 
-                    if self.stop_signal.is_set():
-                        # We're done
-                        return
+                if self.stop_signal.is_set():
+                    # We're done
+                    return
 
                 # Call
                 self.sequence.on_epoch_end()    # Call the internal on epoch end.
-                self._send_sequence()           # Update the pool
+                self._send_sequence()           # Update the workers
                 self.e_idx += 1                 # Increase the internal epoch index
             else:
                 self.pause_sleep(self.pause_sleep_time)
                 continue
 
+    def _read_results(self):
+        """Moves the results of the worker processes from the result queue to the result buffer."""
+        while True:
+            result = self.result_queue.get(block=True)
+
+            # Poison pill - we are done
+            if result is None:
+                break
+
+            self.result_buffer.put(result)
+
+    def _get_result(self, seq_no):
+        # type: (int) -> object
+
+        """Waits for the result with the given sequence number. Results that arrive
+        out of order are buffered until they are requested.
+
+        # Arguments
+            seq_no: sequence number of the task
+        # Returns
+            The batch generated by the worker or None if the enqueuer was stopped
+        """
+        # The previous batch has been consumed, its shared memory slot can be reused
+        if self.shared_memory_slot_in_use is not None:
+            self.shared_memory_pool.release(self.shared_memory_slot_in_use)
+            self.shared_memory_slot_in_use = None
+
+        while True:
+            result = self.result_buffer.pop(seq_no, timeout=self.result_wait_time)
+
+            if result is not None:
+                break
+
+            if not self.is_running():
+                return None
+
+            if not all(worker.is_alive() for worker in self.worker_threads):
+                raise RuntimeError('OrderedEnqueuer worker died unexpectedly')
+
+        success, value = result
+
+        # Rethrow any exceptions from the workers
+        if not success:
+            raise value
+
+        # The returned arrays are views on the slot, which is kept until the next batch is requested
+        if isinstance(value, SharedMemoryBatch):
+            self.shared_memory_slot_in_use = value.slot
+            value = self.shared_memory_pool.read(value)
+
+        return value
+
     def get(self):
         """Creates a generator to extract data from the queue.
 
@@ -335,8 +651,16 @@ class OrderedEnqueuer(SequenceEnqueuer):
         """
         try:
             while self.is_running():
-                inputs = self.queue.get(block=True).get()
+                # Free the queue slot before waiting for the worker, so the next task can be
+                # submitted while this batch is still being generated
+                seq_no = self.queue.get(block=True)
                 self.queue.task_done()
+
+                # Sentinel from stop()
+                if seq_no is None:
+                    break
+
+                inputs = self._get_result(seq_no)
                 if inputs is not None:
                     yield inputs
         except Exception as e:
@@ -347,7 +671,10 @@ class OrderedEnqueuer(SequenceEnqueuer):
     def _send_sequence(self):
         """Send current Sequence to all workers."""
         global _SHARED_SEQUENCES
-        # For new processes that may spawn
+        # Threads see the update through the shared globals. The persistent worker processes
+        # keep the sequence they were forked with: the data set iterators hold memory maps,
+        # open files and locks that can't be pickled. This relies on every on_epoch_end in
+        # iterators.py being a no-op, so there is no later state the workers would miss.
         _SHARED_SEQUENCES[self.uid] = self.sequence
 
     def stop(self, timeout=None):
@@ -364,13 +691,46 @@ class OrderedEnqueuer(SequenceEnqueuer):
 
         self.stop_signal.set()
 
-        with self.queue.mutex:
-            self.queue.queue.clear()
-            self.queue.unfinished_tasks = 0
-            self.queue.not_full.notify()
+        # Wake up a consumer waiting on an empty queue, if the queue is full nobody is waiting
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
 
+        # The run thread notices the stop signal within result_wait_time even if blocked on a full queue
         self.run_thread.join(timeout)
 
+        # Poison pill for every worker
+        for index_queue in self.index_queues:
+            index_queue.put(None)
+
+        for worker in self.worker_threads:
+            if self.use_multiprocessing:
+                # A process with results still buffered for the result queue cannot exit
+                # on its own - terminate the ones that do not exit in time
+                worker.join(timeout or self.result_wait_time)
+
+                if worker.is_alive():
+                    worker.terminate()
+            else:
+                worker.join(timeout)
+
+        if self.use_multiprocessing:
+            for index_queue in self.index_queues:
+                index_queue.cancel_join_thread()
+
+            if self.shared_memory_pool is not None:
+                self.shared_memory_pool.free_slots.cancel_join_thread()
+
+            # The reader is a daemon thread, don't hang if a terminated worker left the pipe broken
+            self.result_queue.put(None)
+            self.result_thread.join(timeout or self.result_wait_time)
+
+        self.worker_threads = []
+        self.index_queues = []
+        self.shared_memory_pool = None
+        self.shared_memory_slot_in_use = None
+
         # Clean up any resources shared by the processes
         global _SHARED_SEQUENCES
         _SHARED_SEQUENCES[self.uid] = None
@@ -396,7 +756,8 @@ class GeneratorEnqueuer(SequenceEnqueuer):
     # Arguments
         generator: a generator function which endlessly yields data
         use_multiprocessing: use multiprocessing if True, otherwise threading
-        wait_time: time to sleep in-between calls to `put()`
+        wait_time: timeout of a blocking `put()` to a full queue before checking
+            whether the enqueuer has been stopped
         seed: Initial seed for workers,
             will be incremented by one for each workers.
     """
@@ -424,6 +785,7 @@ class GeneratorEnqueuer(SequenceEnqueuer):
         self.seed = seed
         self.paused = False
         self.pause_sleep_time = 1.0
+        self.get_timeout = 1.0
         self.last_queue_size_report_time = 0.0
         self._logger = None
 
@@ -431,52 +793,66 @@ class GeneratorEnqueuer(SequenceEnqueuer):
             random.seed(seed)
             np.random.seed(seed)
 
-    def _data_generator_task(self):
+    def _put(self, item):
+        """Blocks until there is room in the queue or the enqueuer is stopped."""
+        while not self._stop_event.is_set():
+            try:
+                self.queue.put(item, block=True, timeout=self.wait_time)
+                return
+            except queue.Full:
+                continue
+
+    def _data_generator_task(self, seed=None):
+        """Producer loop of a worker thread or process.
+
+        # Arguments
+            seed: random seed of a worker process - None seeds from the OS entropy source.
+                Not used with threads, which share the random state of the parent.
+        """
         if self._use_multiprocessing is False:
             while not self._stop_event.is_set():
                 if self.paused:
                     self.pause_sleep(self.pause_sleep_time)
                 else:
-                    with self.genlock:
-                        try:
-                            if (self.queue is not None and
-                                    self.queue.qsize() < self.max_queue_size):
-                                # On all OSes, avoid **SYSTEMATIC** error
-                                # in multithreading mode:
-                                # `ValueError: generator already executing`
-                                # => Serialize calls to
-                                # infinite iterator/generator's next() function
-                                generator_output = next(self._generator)
-                                self.queue.put((True, generator_output))
-                            else:
-                                time.sleep(self.wait_time)
-
-                            if settings.QUEUE_SIZE_REPORT_INTERVAL is not None:
-                                if time.time() - self.last_queue_size_report_time > settings.QUEUE_SIZE_REPORT_INTERVAL:
-                                    self.last_queue_size_report_time = time.time()
-                                    self.logger.log('Queue size: {}'.format(self.queue.qsize()))
-                        except StopIteration:
-                            break
-                        except Exception as e:
-                            # Can't pickle tracebacks.
-                            # As a compromise, print the traceback and pickle None instead.
-                            if not hasattr(e, '__traceback__'):
-                                setattr(e, '__traceback__', sys.exc_info()[2])
-                            self.queue.put((False, e))
-                            self._stop_event.set()
-                            break
+                    try:
+                        with self.genlock:
+                            # On all OSes, avoid **SYSTEMATIC** error
+                            # in multithreading mode:
+                            # `ValueError: generator already executing`
+                            # => Serialize calls to
+                            # infinite iterator/generator's next() function
+                            generator_output = next(self._generator)
+
+                        # The bounded queue blocks the producer when full
+                        self._put((True, generator_output))
+
+                        if settings.QUEUE_SIZE_REPORT_INTERVAL is not None:
+                            if time.time() - self.last_queue_size_report_time > settings.QUEUE_SIZE_REPORT_INTERVAL:
+                                self.last_queue_size_report_time = time.time()
+                                self.logger.log('Queue size: {}'.format(self.queue.qsize()))
+                    except StopIteration:
+                        break
+                    except Exception as e:
+                        # Can't pickle tracebacks.
+                        # As a compromise, print the traceback and pickle None instead.
+                        if not hasattr(e, '__traceback__'):
+                            setattr(e, '__traceback__', sys.exc_info()[2])
+                        self.queue.put((False, e))
+                        self._stop_event.set()
+                        break
         else:
+            random.seed(seed)
+            np.random.seed(seed)
+
             while not self._stop_event.is_set():
                 if self.paused:
                     self.pause_sleep(self.pause_sleep_time)
                 else:
                     try:
-                        if (self.queue is not None and
-                                self.queue.qsize() < self.max_queue_size):
-                            generator_output = next(self._generator)
-                            self.queue.put((True, generator_output))
-                        else:
-                            time.sleep(self.wait_time)
+                        generator_output = next(self._generator)
+
+                        # The bounded queue blocks the producer when full
+                        self._put((True, generator_output))
 
                         if settings.QUEUE_SIZE_REPORT_INTERVAL is not None:
                             if time.time() - self.last_queue_size_report_time > settings.QUEUE_SIZE_REPORT_INTERVAL:
@@ -515,15 +891,13 @@ class GeneratorEnqueuer(SequenceEnqueuer):
                 self.queue = queue.Queue(maxsize=max_queue_size)
                 self._stop_event = threading.Event()
 
-            for _ in range(workers):
+            for i in range(workers):
                 if self._use_multiprocessing:
-                    # Reset random seed else all children processes
-                    # share the same seed
-                    np.random.seed(self.seed)
-                    thread = multiprocessing.Process(target=self._data_generator_task)
+                    # Each child process seeds itself, else all children processes
+                    # share the random state inherited from the parent
+                    worker_seed = self.seed + i if self.seed is not None else None
+                    thread = multiprocessing.Process(target=self._data_generator_task, args=(worker_seed,))
                     thread.daemon = True
-                    if self.seed is not None:
-                        self.seed += 1
                 else:
                     thread = threading.Thread(target=self._data_generator_task)
                 self._threads.append(thread)
@@ -575,20 +949,20 @@ class GeneratorEnqueuer(SequenceEnqueuer):
             `(inputs, targets, sample_weights)`.
         """
         while self.is_running():
-            if not self.queue.empty():
-                success, value = self.queue.get()
-                # Rethrow any exceptions found in the queue
-                if not success:
-                    six.reraise(value.__class__, value, value.__traceback__)
-                # Yield regular values
-                if value is not None:
-                    yield value
-            else:
+            try:
+                success, value = self.queue.get(block=True, timeout=self.get_timeout)
+            except queue.Empty:
                 all_finished = all([not thread.is_alive() for thread in self._threads])
                 if all_finished and self.queue.empty():
                     raise StopIteration()
-                else:
-                    time.sleep(self.wait_time)
+                continue
+
+            # Rethrow any exceptions found in the queue
+            if not success:
+                six.reraise(value.__class__, value, value.__traceback__)
+            # Yield regular values
+            if value is not None:
+                yield value
 
         # Make sure to rethrow the first exception in the queue, if any
         while not self.queue.empty():
@@ -1,8 +1,33 @@
 # coding=utf-8
 
+from __future__ import division
+
+import numpy as np
+
 from keras import backend as K
 from keras.layers import Layer
 
+import settings
+
+# Whether there is a GPU available, looked up once on the first pooling layer construction
+_GPU_AVAILABLE = None
+
+
+def _is_gpu_available():
+    global _GPU_AVAILABLE
+
+    if _GPU_AVAILABLE is None:
+        # Listing the physical devices is cheaper (does not create the device contexts) but
+        # is only available in newer TF versions
+        if hasattr(K.tf, 'config') and hasattr(K.tf.config, 'list_physical_devices'):
+            _GPU_AVAILABLE = len(K.tf.config.list_physical_devices('GPU')) > 0
+        else:
+            from tensorflow.python.client import device_lib
+            local_device_protos = device_lib.list_local_devices()
+            _GPU_AVAILABLE = any(x.device_type == 'GPU' for x in local_device_protos)
+
+    return _GPU_AVAILABLE
+
 
 class MaxPoolingWithArgmax2D(Layer):
 
@@ -18,10 +43,7 @@ class MaxPoolingWithArgmax2D(Layer):
             raise NotImplementedError('{} backend is not supported for layer {}'.format(K.backend(), type(self).__name__))
 
         # Check whether we are running on GPU to decide which version of pooling to use
-        from tensorflow.python.client import device_lib
-        local_device_protos = device_lib.list_local_devices()
-        gpus = [x.name for x in local_device_protos if x.device_type == 'GPU']
-        self.running_on_gpu = len(gpus) > 0
+        self.running_on_gpu = _is_gpu_available()
 
         if not self.running_on_gpu:
             raise NotImplementedError('MaxPoolingWithArgmax2D works only on GPU')
@@ -45,12 +67,14 @@ class MaxPoolingWithArgmax2D(Layer):
         strides = [1, strides[0], strides[1], 1]
         output, argmax = K.tf.nn.max_pool_with_argmax(inputs, ksize=ksize, strides=strides, padding=padding)
 
-        argmax = K.cast(argmax, K.floatx())
+        # Pass the indices on as float32 also when floatx is float16: float16 represents
+        # integers exactly only up to 2048 which would scatter to the wrong positions
+        argmax = K.cast(argmax, 'float32')
         return [output, argmax]
 
     def compute_output_shape(self, input_shape):
         ratio = (1, 2, 2, 1)
-        output_shape = [dim / ratio[idx] if dim is not None else None for idx, dim in enumerate(input_shape)]
+        output_shape = [dim // ratio[idx] if dim is not None else None for idx, dim in enumerate(input_shape)]
         output_shape = tuple(output_shape)
         return [output_shape, output_shape]
 
@@ -64,8 +88,17 @@ class MaxUnpooling2D(Layer):
         super(MaxUnpooling2D, self).__init__(**kwargs)
         self.size = size
         self.kwargs = kwargs
+        self._batch_offset = None
 
     def build(self, input_shape):
+        pool_shape = input_shape[0]
+
+        # If the input shape is fully static the batch offsets of the flat indices
+        # can be computed once here instead of building the ops on every call
+        if None not in pool_shape:
+            flat_image_output_size = pool_shape[1] * self.size[0] * pool_shape[2] * self.size[1] * pool_shape[3]
+            self._batch_offset = np.arange(pool_shape[0], dtype=np.int64).reshape(pool_shape[0], 1, 1, 1) * flat_image_output_size
+
         super(MaxUnpooling2D, self).build(input_shape)
 
     def call(self, inputs, output_shape=None):
@@ -77,31 +110,43 @@ class MaxUnpooling2D(Layer):
         pool = inputs[0]
         ind = K.tf.cast(inputs[1], dtype=K.tf.int64)
 
-        with K.tf.variable_scope(self.name):
-            input_shape = K.tf.shape(pool, out_type='int64')
-            output_shape = [input_shape[0], input_shape[1] * self.size[0], input_shape[2] * self.size[1], input_shape[3]]
+        # Compile the index building, scatter and reshapes into a single XLA cluster
+        if settings.XLA_COMPILE_UNPOOLING:
+            from tensorflow.contrib.compiler import jit
+
+            with jit.experimental_jit_scope(compile_ops=True):
+                return self._unpool(pool, ind)
+
+        return self._unpool(pool, ind)
+
+    def _unpool(self, pool, ind):
+        input_shape = K.tf.shape(pool, out_type='int64')
+        output_shape = [input_shape[0], input_shape[1] * self.size[0], input_shape[2] * self.size[1], input_shape[3]]
 
-            flat_input_size = K.tf.reduce_prod(input_shape)
-            flat_output_shape = [output_shape[0], output_shape[1] * output_shape[2] * output_shape[3]]
+        flat_input_size = K.tf.reduce_prod(input_shape)
+        flat_image_output_size = output_shape[1] * output_shape[2] * output_shape[3]
 
-            pool_ = K.tf.reshape(pool, shape=K.tf.stack([flat_input_size]))
-            batch_range = K.tf.reshape(K.tf.range(K.tf.cast(output_shape[0], dtype=K.tf.int64), dtype=ind.dtype), shape=K.tf.stack([input_shape[0], 1, 1, 1]))
-            b = K.tf.ones_like(ind) * batch_range
-            b1 = K.tf.reshape(b, shape=K.tf.stack([flat_input_size, 1]))
-            ind_ = K.tf.reshape(ind, shape=K.tf.stack([flat_input_size, 1]))
-            ind_ = K.tf.concat([b1, ind_], 1)
+        # The argmax indices are flat indices within each image - offset them by the image's
+        # position in the batch to get flat indices into the whole output and scatter in 1D.
+        # Avoids materializing a [N, 2] (batch, index) index tensor.
+        if self._batch_offset is not None:
+            batch_offset = K.tf.constant(self._batch_offset)
+        else:
+            batch_offset = K.tf.reshape(K.tf.range(output_shape[0], dtype=ind.dtype) * flat_image_output_size, shape=K.tf.stack([input_shape[0], 1, 1, 1]))
 
-            ret = K.tf.scatter_nd(ind_, pool_, shape=K.tf.cast(flat_output_shape, K.tf.int64))
-            ret = K.tf.reshape(ret, shape=K.tf.stack(output_shape))
+        ind_ = K.tf.reshape(ind + batch_offset, shape=K.tf.stack([flat_input_size, 1]))
+        pool_ = K.tf.reshape(pool, shape=K.tf.stack([flat_input_size]))
 
-            set_input_shape = pool.get_shape()
-            set_output_shape = [set_input_shape[0],
-                                set_input_shape[1] * self.size[0],
-                                set_input_shape[2] * self.size[1],
-                                set_input_shape[3]]
-            ret.set_shape(set_output_shape)
-            return ret
+        ret = K.tf.scatter_nd(ind_, pool_, shape=K.tf.stack([output_shape[0] * flat_image_output_size]))
+        ret = K.tf.reshape(ret, shape=K.tf.stack(output_shape))
 
+        set_input_shape = pool.get_shape()
+        set_output_shape = [set_input_shape[0],
+                            set_input_shape[1] * self.size[0],
+                            set_input_shape[2] * self.size[1],
+                            set_input_shape[3]]
+        ret.set_shape(set_output_shape)
+        return ret
 
     def compute_output_shape(self, input_shape):
         mask_shape = input_shape[1]
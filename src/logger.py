@@ -40,7 +40,8 @@ class Logger(object):
     _log_images_folder_path = None
     _log_file_path = None
     _log_file = None
-    _buf_size = 5
+    _buf_size = 1 << 16                     # Log file write buffer in bytes, flushed explicitly via flush_log
+    _max_stdout_message_length = 64 * 1024  # Longer messages are written only to the log file
 
     def __init__(self, log_file_path, log_images_folder_path=None, use_timestamp=True, log_to_stdout_default=True, stdout_only=False):
         # type: (str, bool, bool) -> None
@@ -112,9 +113,10 @@ class Logger(object):
                 else:
                     Logger._log_file.write(message)
 
-        # Log to stdout - no newline needed
+        # Log to stdout - no newline needed, very long messages are not echoed unless there is no log file
         if log_to_stdout or self.log_to_stdout_default or self.stdout_only:
-            print message.strip()
+            if self.stdout_only or len(message) <= Logger._max_stdout_message_length:
+                print message.strip()
 
     def warn(self, message, log_to_stdout=False):
         self.log(message, log_level=LogLevel.WARNING, log_to_stdout=log_to_stdout)
@@ -155,6 +157,11 @@ class Logger(object):
                 else:
                     raise ValueError('Invalid log file path, cannot log')
 
+    def flush_log(self):
+        with Logger._file_write_lock:
+            if Logger._log_file is not None and not Logger._log_file.closed:
+                Logger._log_file.flush()
+
     def close_log(self):
         with Logger._file_write_lock:
             # If the log file is open close it
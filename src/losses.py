@@ -22,10 +22,34 @@ class ModelLambdaLossType(Enum):
     CLASSIFICATION_SEMI_SUPERVISED_MEAN_TEACHER = 6
 
 
+##############################################
+# GLOBALS
+##############################################
+
+# Sobel masks for the superpixel cost (HxWxINxMULTIPLIER), built once instead of per graph construction
+_SOBEL_X = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]], dtype=np.float32).reshape((3, 3, 1, 1))
+_SOBEL_Y = np.ascontiguousarray(np.transpose(_SOBEL_X, (1, 0, 2, 3)))
+
+
 ##############################################
 # UTILITY FUNCTIONS
 ##############################################
 
+def _tf_full_like(t, value):
+    """
+    Creates a tensor of the same shape and type as 't' filled with 'value'. A single
+    fill op instead of ones_like(t) * value, which materializes two full tensors.
+
+    # Arguments
+        :param t: A tensor
+        :param value: The scalar fill value
+    # Returns
+        :return: A tensor of same shape as t filled with value
+    """
+
+    return K.tf.fill(K.tf.shape(t), K.tf.cast(value, dtype=t.dtype))
+
+
 def _tf_filter_nans(t, replace):
     """
     Filter NaNs from a tensor 't' and replace with value epsilon
@@ -37,7 +61,7 @@ def _tf_filter_nans(t, replace):
         :return: A tensor of same shape as t with NaN values replaced by epsilon.
     """
 
-    return K.tf.where(K.tf.is_nan(t), K.tf.ones_like(t) * replace, t)
+    return K.tf.where(K.tf.is_nan(t), _tf_full_like(t, replace), t)
 
 
 def _tf_filter_infs(t, replace):
@@ -51,7 +75,7 @@ def _tf_filter_infs(t, replace):
         :return: A tensor of same shape as t with NaN values replaced by epsilon.
     """
 
-    return K.tf.where(K.tf.is_inf(t), K.tf.ones_like(t) * replace, t)
+    return K.tf.where(K.tf.is_inf(t), _tf_full_like(t, replace), t)
 
 
 def _tf_filter_infinite(t, replace):
@@ -64,11 +88,11 @@ def _tf_filter_infinite(t, replace):
     # Returns
         :return: tensor where infinite values have been replaced
     """
-    return K.tf.where(K.tf.is_finite(t), t, K.tf.ones_like(t) * replace)
+    return K.tf.where(K.tf.is_finite(t), t, _tf_full_like(t, replace))
 
 
 def _tf_clamp_to_min(t, epsilon):
-    return K.tf.where(K.tf.less(t, epsilon), K.tf.ones_like(t) * epsilon, t)
+    return K.tf.maximum(t, K.tf.cast(epsilon, dtype=t.dtype))
 
 
 def _tf_initialize_local_variables():
@@ -127,8 +151,8 @@ def _tf_unlabeled_superpixel_cost_internal(y_true_unlabeled, y_pred_unlabeled, s
     y_pred_unlabeled_softmax = K.tf.nn.softmax(y_pred_unlabeled, dim=-1)
 
     # Calculate the gradients for the softmax output using a convolution with a Sobel mask
-    S_x = K.tf.tile(K.tf.constant([[1, 2, 1], [0, 0, 0], [-1, -2, -1]], shape=[3, 3, 1, 1], dtype=dtype), [1, 1, num_classes, 1])
-    S_y = K.tf.transpose(S_x, [1, 0, 2, 3])
+    S_x = K.tf.tile(K.tf.constant(_SOBEL_X, dtype=dtype), [1, 1, num_classes, 1])
+    S_y = K.tf.tile(K.tf.constant(_SOBEL_Y, dtype=dtype), [1, 1, num_classes, 1])
     G_x = K.tf.nn.depthwise_conv2d(y_pred_unlabeled_softmax, S_x, strides=[1, 1, 1, 1], padding='SAME')
     G_y = K.tf.nn.depthwise_conv2d(y_pred_unlabeled_softmax, S_y, strides=[1, 1, 1, 1], padding='SAME')
 
@@ -267,19 +291,6 @@ def _segmentation_sparse_weighted_pixelwise_crossentropy_loss(y_true, y_pred, we
 
 def _segmentation_sparse_weighted_categorical_crossentropy_loss_with_weight_expansion(class_weights):
 
-    def get_per_sample_weights(i, weights, y_true):
-        class_weight_val = K.tf.ones_like(y_true, dtype=K.tf.float32) * class_weights[i]
-        zero = K.tf.zeros_like(y_true, dtype=K.tf.float32)
-        class_i_weights = K.tf.where(K.tf.equal(y_true, i), class_weight_val, zero)
-
-        # Add the class weights to the weights array
-        weights = K.tf.add(weights, class_i_weights)
-
-        # Increase the loop variable
-        i = K.tf.add(i, 1)
-
-        return i, weights, y_true
-
     def loss(y_true, y_pred):
         # Sanity checks for argument ranks
         K.tf.assert_rank(y_pred, 4)
@@ -290,12 +301,8 @@ def _segmentation_sparse_weighted_categorical_crossentropy_loss_with_weight_expa
         y_true = K.tf.stop_gradient(K.tf.cast(K.tf.squeeze(y_true, axis=-1), dtype=K.tf.int32))
 
         # Pre-process the weights, we need them separately for every y_true in the batch
-        num_classes = K.tf.stop_gradient(K.tf.shape(y_pred)[-1])
-        weights = K.tf.stop_gradient(K.tf.zeros_like(y_true, dtype=K.tf.float32))
-        i = K.tf.stop_gradient(K.tf.constant(0, dtype=K.tf.int32))
-
-        cond = lambda i, _, __: K.tf.less(i, num_classes)
-        _, weights, __ = K.tf.while_loop(cond=cond, body=get_per_sample_weights, loop_vars=[i, weights, y_true], back_prop=False)
+        # Note: a single gather from the class weights instead of a loop over the classes
+        weights = K.tf.stop_gradient(K.tf.gather(class_weights, y_true))
 
         loss_val = _segmentation_sparse_weighted_pixelwise_crossentropy_loss(y_true=y_true, y_pred=y_pred, weights=weights)
 
@@ -324,8 +331,9 @@ def _preprocess_segmentation_lambda_loss_args(args, num_expected_args):
     K.tf.assert_rank(num_unlabeled, 2)
 
     # Stop gradient while parsing the necessary values
-    num_unlabeled = K.tf.stop_gradient(K.tf.cast(K.tf.squeeze(num_unlabeled[0]), dtype=K.tf.int32))
-    num_labeled = K.tf.stop_gradient(K.tf.shape(y_true)[0] - num_unlabeled)
+    # Note: index both dimensions to get a scalar directly without a squeeze, integers need no stop gradient
+    num_unlabeled = K.tf.cast(num_unlabeled[0, 0], dtype=K.tf.int32)
+    num_labeled = K.tf.shape(y_true)[0] - num_unlabeled
     weights_labeled = K.tf.stop_gradient(weights[0:num_labeled])
 
     return y_pred, y_true, weights_labeled, num_unlabeled, num_labeled
@@ -410,7 +418,7 @@ def segmentation_mean_teacher_lambda_loss(args):
     mt_consistency_cost_coefficient = args[5]
     K.tf.assert_rank(mt_predictions, K.tf.rank(y_pred))
     K.tf.assert_rank(mt_consistency_cost_coefficient, 2)
-    mt_consistency_cost_coefficient = K.tf.stop_gradient(K.tf.squeeze(mt_consistency_cost_coefficient[0]))
+    mt_consistency_cost_coefficient = K.tf.stop_gradient(mt_consistency_cost_coefficient[0, 0])
 
     # Extract the labeled predictions/labels
     y_pred_labeled = y_pred[0:num_labeled]
@@ -464,7 +472,7 @@ def segmentation_superpixel_lambda_loss(args):
 
     # Extract the superpixel consistency cost coefficient
     superpixel_consistency_cost_coefficient = args[4]
-    superpixel_consistency_cost_coefficient = K.tf.stop_gradient(K.tf.squeeze(superpixel_consistency_cost_coefficient[0]))
+    superpixel_consistency_cost_coefficient = K.tf.stop_gradient(superpixel_consistency_cost_coefficient[0, 0])
 
     # Divide into labelled and unlabelled
     y_pred_labeled = y_pred[0:num_labeled]
@@ -533,12 +541,12 @@ def segmentation_mean_teacher_superpixel_lambda_loss(args):
     mt_consistency_coefficient = args[5]
     K.tf.assert_rank(mt_predictions, K.tf.rank(y_pred))
     K.tf.assert_rank(mt_consistency_coefficient, 2)
-    mt_consistency_coefficient = K.tf.stop_gradient(K.tf.squeeze(mt_consistency_coefficient[0]))
+    mt_consistency_coefficient = K.tf.stop_gradient(mt_consistency_coefficient[0, 0])
 
     # Extract the superpixel parameters
     superpixel_consistency_cost_coefficient = args[6]
     K.tf.assert_rank(superpixel_consistency_cost_coefficient, 2)
-    superpixel_consistency_cost_coefficient = K.tf.stop_gradient(K.tf.squeeze(superpixel_consistency_cost_coefficient[0]))
+    superpixel_consistency_cost_coefficient = K.tf.stop_gradient(superpixel_consistency_cost_coefficient[0, 0])
 
     # Divide the data into labelled and unlabelled
     y_pred_labeled = y_pred[0:num_labeled]
@@ -576,26 +584,26 @@ def segmentation_mean_teacher_superpixel_lambda_loss(args):
 # CLASSIFICATION LOSS FUNCTIONS
 ####################################################################
 
-def _classification_weighted_categorical_crossentropy_loss(y_true, y_pred, class_weights):
-    # Calculate cross-entropy loss
-    epsilon = _to_tensor(settings.EPSILON, y_pred.dtype.base_dtype)
-    softmax = K.tf.nn.softmax(y_pred)
-    softmax = K.tf.clip_by_value(softmax, epsilon, 1.0)
-    xent = K.tf.multiply(y_true * K.tf.log(softmax), class_weights)
+def _classification_weighted_categorical_crossentropy_loss_from_log_softmax(y_true, log_softmax, class_weights):
+    xent = K.tf.multiply(y_true * log_softmax, class_weights)
     xent = -K.tf.reduce_mean(K.tf.reduce_sum(xent, axis=-1))
 
     return xent
 
 
+def _classification_weighted_categorical_crossentropy_loss(y_true, y_pred, class_weights):
+    # Calculate cross-entropy loss
+    # Note: log softmax is numerically stable, no need to clip the softmax or filter NaNs before the log
+    log_softmax = K.tf.nn.log_softmax(y_pred)
+
+    return _classification_weighted_categorical_crossentropy_loss_from_log_softmax(y_true=y_true,
+                                                                                   log_softmax=log_softmax,
+                                                                                   class_weights=class_weights)
+
+
 def _classification_weighted_categorical_crossentropy_loss_internal(class_weights):
     def loss(y_true, y_pred):
-        epsilon = _to_tensor(settings.EPSILON, y_pred.dtype.base_dtype)
-        softmax = K.tf.nn.softmax(y_pred)
-        softmax = K.tf.clip_by_value(softmax, epsilon, 1.0)
-        xent = K.tf.multiply(y_true * K.tf.log(softmax), class_weights)
-        xent = -K.tf.reduce_mean(K.tf.reduce_sum(xent, axis=-1))
-
-        return xent
+        return _classification_weighted_categorical_crossentropy_loss(y_true=y_true, y_pred=y_pred, class_weights=class_weights)
 
     return loss
 
@@ -626,8 +634,9 @@ def _preprocess_classification_lambda_loss_args(args, num_expected_args):
     K.tf.assert_rank(num_unlabeled, 2)
 
     # Stop the gradient while parsing the necessary values
-    num_unlabeled = K.tf.stop_gradient(K.tf.cast(K.tf.squeeze(num_unlabeled[0]), dtype=K.tf.int32))
-    num_labeled = K.tf.stop_gradient(K.tf.shape(y_true)[0] - num_unlabeled)
+    # Note: index both dimensions to get a scalar directly without a squeeze, integers need no stop gradient
+    num_unlabeled = K.tf.cast(num_unlabeled[0, 0], dtype=K.tf.int32)
+    num_labeled = K.tf.shape(y_true)[0] - num_unlabeled
     weights_labeled = K.tf.stop_gradient(weights[0:num_labeled])
 
     return y_pred, y_true, weights_labeled, num_unlabeled, num_labeled
@@ -685,23 +694,26 @@ def classification_mean_teacher_lambda_loss(args):
     mt_consistency_coefficient = args[5]
     K.tf.assert_rank(mt_predictions, K.tf.rank(y_pred))
     K.tf.assert_rank(mt_consistency_coefficient, 2)
-    mt_consistency_coefficient = K.tf.stop_gradient(K.tf.squeeze(mt_consistency_coefficient[0]))
+    mt_consistency_coefficient = K.tf.stop_gradient(mt_consistency_coefficient[0, 0])
+
+    # Calculate the student log softmax once - used for both the classification and consistency costs
+    student_log_softmax = K.tf.nn.log_softmax(y_pred)
 
     # Separate labeled samples
-    y_pred_labeled = y_pred[0:num_labeled]
+    student_log_softmax_labeled = student_log_softmax[0:num_labeled]
     y_true_labeled = y_true[0:num_labeled]
 
     """
     Classification cost calculation - only for labeled
     """
-    classification_costs = _classification_weighted_categorical_crossentropy_loss(y_true=y_true_labeled,
-                                                                                  y_pred=y_pred_labeled,
-                                                                                  class_weights=weights_labeled)
+    classification_costs = _classification_weighted_categorical_crossentropy_loss_from_log_softmax(y_true=y_true_labeled,
+                                                                                                   log_softmax=student_log_softmax_labeled,
+                                                                                                   class_weights=weights_labeled)
 
     """
     Consistency costs - for labeled and unlabeled
     """
-    student_softmax = K.tf.nn.softmax(y_pred, dim=-1)
+    student_softmax = K.tf.exp(student_log_softmax)
     teacher_softmax = K.tf.nn.softmax(mt_predictions, dim=-1)
 
     # Calculate the MSE between the softmax predictions
@@ -23,6 +23,7 @@ from keras_extensions.extended_model import ExtendedModel
 from logger import Logger
 
 import losses
+import settings
 from losses import ModelLambdaLossType
 
 
@@ -577,6 +578,25 @@ class ModelBase(object):
 
         raise NotImplementedError('This method should be implemented in the class derived from ModelBase')
 
+    def _get_lambda_loss_layer(self, lambda_inputs):
+        """
+        Applies the lambda loss function to the lambda inputs. With settings.XLA_COMPILE_LAMBDA_LOSS
+        the loss ops (and their gradients) are compiled with XLA so that the elementwise loss
+        arithmetic is fused into a few kernels.
+
+        # Arguments
+            :param lambda_inputs: inputs to the lambda loss layer
+        # Returns
+            :return: the output of the lambda loss layer
+        """
+        if settings.XLA_COMPILE_LAMBDA_LOSS:
+            from tensorflow.contrib.compiler import jit
+
+            with jit.experimental_jit_scope(compile_ops=True):
+                return Lambda(self.lambda_loss_function, output_shape=(1,), name='loss')(lambda_inputs)
+
+        return Lambda(self.lambda_loss_function, output_shape=(1,), name='loss')(lambda_inputs)
+
     def _get_segmentation_categorical_cross_entropy_lambda_loss_model(self):
         if self.inputs is None or self.outputs is None:
             raise RuntimeError('The model must be built by calling _build_model() first')
@@ -596,7 +616,7 @@ class ModelBase(object):
         # Note: assumes there is only a single output, which is the last layer
         logits = self.outputs[0]
         lambda_inputs = [logits, labels, class_weights, num_unlabeled]
-        loss_layer = Lambda(self.lambda_loss_function, output_shape=(1,), name='loss')(lambda_inputs)
+        loss_layer = self._get_lambda_loss_layer(lambda_inputs)
         self.outputs = [loss_layer, logits]
 
         model = ExtendedModel(name=self.name, inputs=self.inputs, outputs=self.outputs)
@@ -630,7 +650,7 @@ class ModelBase(object):
         # Note: assumes there is only a single output, which is the last layer
         logits = self.outputs[0]
         lambda_inputs = [logits, labels, class_weights, num_unlabeled, mt_predictions, consistency_cost]
-        loss_layer = Lambda(self.lambda_loss_function, output_shape=(1,), name='loss')(lambda_inputs)
+        loss_layer = self._get_lambda_loss_layer(lambda_inputs)
         self.outputs = [loss_layer, logits]
 
         model = ExtendedModel(name=self.name, inputs=self.inputs, outputs=self.outputs)
@@ -660,7 +680,7 @@ class ModelBase(object):
         # Note: assumes there is only a single output, which is the last layer
         logits = self.outputs[0]
         lambda_inputs = [logits, labels, class_weights, num_unlabeled, unlabeled_cost_coeff]
-        loss_layer = Lambda(self.lambda_loss_function, output_shape=(1,), name='loss')(lambda_inputs)
+        loss_layer = self._get_lambda_loss_layer(lambda_inputs)
         self.outputs = [loss_layer, logits]
 
         model = ExtendedModel(name=self.name, inputs=self.inputs, outputs=self.outputs)
@@ -697,7 +717,7 @@ class ModelBase(object):
         # Note: assumes there is only a single output, which is the last layer
         logits = self.outputs[0]
         lambda_inputs = [logits, labels, class_weights, num_unlabeled, mt_predictions, consistency_cost, unlabeled_cost_coeff]
-        loss_layer = Lambda(self.lambda_loss_function, output_shape=(1,), name='loss')(lambda_inputs)
+        loss_layer = self._get_lambda_loss_layer(lambda_inputs)
         self.outputs = [loss_layer, logits]
 
         model = ExtendedModel(name=self.name, inputs=self.inputs, outputs=self.outputs)
@@ -722,7 +742,7 @@ class ModelBase(object):
         # Note: assumes there is only a single output, which is the last layer
         logits = self.outputs[0]
         lambda_inputs = [logits, labels, class_weights, num_unlabeled]
-        loss_layer = Lambda(self.lambda_loss_function, output_shape=(1,), name='loss')(lambda_inputs)
+        loss_layer = self._get_lambda_loss_layer(lambda_inputs)
         self.outputs = [loss_layer, logits]
 
         model = ExtendedModel(name=self.name, inputs=self.inputs, outputs=self.outputs)
@@ -756,7 +776,7 @@ class ModelBase(object):
         # Note: assumes there is only a single output, which is the last layer
         logits = self.outputs[0]
         lambda_inputs = [logits, labels, class_weights, num_unlabeled, mt_predictions, consistency_cost]
-        loss_layer = Lambda(self.lambda_loss_function, output_shape=(1,), name='loss')(lambda_inputs)
+        loss_layer = self._get_lambda_loss_layer(lambda_inputs)
         self.outputs = [loss_layer, logits]
 
         model = ExtendedModel(name=self.name, inputs=self.inputs, outputs=self.outputs)
@@ -6,11 +6,13 @@ import time
 import argparse
 import math
 
-import matplotlib as mpl
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
-import pydensecrf.utils as dcrf_utils
+from keras import backend as K
+from keras.layers import Input, Lambda
+from keras.models import Model
 from keras.preprocessing.image import load_img, img_to_array, array_to_img
-from matplotlib import pyplot as plt
 
 from scipy import ndimage
 
@@ -28,6 +30,11 @@ from models import get_model
 CONFIG = None
 DPI = 120
 FIGURE_INDEX = 0
+PREFETCH_PREDICT_FUNCTIONS = {}
+
+# Matplotlib is imported lazily, only when the plots are built
+mpl = None
+plt = None
 
 
 ##############################################
@@ -50,27 +57,26 @@ def np_softmax(X, theta=1.0, axis=None):
     along the specified axis.
     """
 
-    # make X at least 2d
-    y = np.atleast_2d(X)
+    # make X at least 2d, copy once and do the rest of the work in-place
+    y = np.array(np.atleast_2d(X), dtype=np.result_type(X, np.float32))
 
     # find axis
     if axis is None:
         axis = next(j[0] for j in enumerate(y.shape) if j[1] > 1)
 
     # multiply y against the theta parameter,
-    y = y * float(theta)
+    if theta != 1.0:
+        y *= float(theta)
 
     # subtract the max for numerical stability
-    y = y - np.expand_dims(np.max(y, axis=axis), axis)
+    y -= np.max(y, axis=axis, keepdims=True)
 
     # exponentiate y
-    y = np.exp(y)
-
-    # take the sum along the specified axis
-    ax_sum = np.expand_dims(np.sum(y, axis=axis), axis)
+    np.exp(y, out=y)
 
-    # finally: divide elementwise
-    p = y / ax_sum
+    # finally: divide elementwise by the sum along the specified axis
+    y /= np.sum(y, axis=axis, keepdims=True)
+    p = y
 
     # flatten if X was 1D
     if X.ndim == 1:
@@ -84,7 +90,7 @@ def np_softmax(X, theta=1.0, axis=None):
 ##############################################
 
 class PredictionImage(object):
-    def __init__(self, image_path, data_set_information, sdim=None, scale_factor=1.0, div2_constraint=4, labeled_only=False):
+    def __init__(self, image_path, data_set_information, sdim=None, scale_factor=1.0, div2_constraint=4, labeled_only=False, normalize=True):
         print 'Loading image from: {}'.format(image_path)
         self.pil_image = load_img(image_path)
         self.file_name = os.path.basename(image_path)
@@ -94,11 +100,16 @@ class PredictionImage(object):
             self.pil_image = pil_resize_image_to_sdim(self.pil_image, sdim, interp='bicubic')
 
         print 'Loaded image of size: {}'.format(self.pil_image.size)
-        self.np_image = img_to_array(self.pil_image)
+        # Keep the unnormalized image data for post-processing (CRF) as uint8, the
+        # normalization casts it to float32 into a new array
+        self.raw_np_image = np.asarray(self.pil_image, dtype=np.uint8)
+        self.np_image = self.raw_np_image
 
         print 'Pre-processing image data with div2 constraint: {} labeled only: {}'.format(div2_constraint, labeled_only)
         per_channel_mean = data_set_information.labeled_per_channel_mean if labeled_only else data_set_information.per_channel_mean
         per_channel_stddev = data_set_information.labeled_per_channel_stddev if labeled_only else data_set_information.per_channel_stddev
+        per_channel_mean = np.asarray(per_channel_mean, dtype=np.float32)
+        per_channel_stddev = np.asarray(per_channel_stddev, dtype=np.float32)
 
         self.original_shape = self.np_image.shape[:2]
         self.scale_factor = scale_factor
@@ -112,7 +123,17 @@ class PredictionImage(object):
             self.np_image = image_utils.np_scale_image(self.np_image, sfactor=scale_factor, interp='bicubic')
             self.scaled = True
 
-        self.np_image = image_utils.np_normalize_image_channels(self.np_image, per_channel_mean=per_channel_mean, per_channel_stddev=per_channel_stddev)
+        pad_cval = data_set_information.per_channel_mean
+
+        # If the normalization is done by the model keep the image as uint8 and
+        # pad with the uint8 value closest to the normalized padding value
+        if normalize:
+            self.np_image = image_utils.np_normalize_image_channels(self.np_image, per_channel_mean=per_channel_mean, per_channel_stddev=per_channel_stddev, inplace=True)
+        else:
+            self.np_image = self.np_image.astype(np.uint8, copy=False)
+            scale, offset = image_utils.get_normalization_scale_and_offset(per_channel_mean=per_channel_mean, per_channel_stddev=per_channel_stddev)
+            pad_cval = np.clip(np.round((np.asarray(pad_cval, dtype=np.float32) - offset) / scale), 0, 255).astype(np.uint8)
+
         div2_constraint = div2_constraint
 
         self.padded = False
@@ -121,7 +142,7 @@ class PredictionImage(object):
         if dataset_utils.count_trailing_zeroes(self.np_image.shape[0]) < div2_constraint or \
                         dataset_utils.count_trailing_zeroes(self.np_image.shape[1]) < div2_constraint:
             self.np_image, self.v_pad_before, self.v_pad_after, self.h_pad_before, self.h_pad_after =\
-                pad_image_to_div2_constraint(self.np_image, div2_constraint, data_set_information.per_channel_mean)
+                pad_image_to_div2_constraint(self.np_image, div2_constraint, pad_cval)
             self.padded = True
 
 
@@ -188,6 +209,245 @@ def pad_image_to_div2_constraint(image_array, div2_constraint, cval):
     return padded_image_array, v_pad_before, v_pad_after, h_pad_before, h_pad_after
 
 
+def get_tile_offsets(length, tile_length, stride):
+    # type: (int, int, int) -> list[int]
+
+    """
+    Returns the start offsets of the tiles covering the given length. The last tile is
+    aligned to the end so all the tiles are of the same length.
+
+    # Arguments
+        :param length: length of the dimension
+        :param tile_length: length of a tile
+        :param stride: distance between consecutive tile starts
+    # Returns
+        :return: list of tile start offsets
+    """
+
+    offsets = range(0, max(length - tile_length, 0) + 1, stride)
+
+    if offsets[-1] + tile_length < length:
+        offsets.append(length - tile_length)
+
+    return offsets
+
+
+def is_saved_model_dir(path):
+    # type: (str) -> bool
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, 'saved_model.pb'))
+
+
+class SavedModelPredictor(object):
+    """
+    Loads a SavedModel exported with export.py into the Keras session and provides
+    a predict function compatible with keras.models.Model.predict.
+    """
+
+    def __init__(self, saved_model_path):
+        tf = K.tf
+        self.session = K.get_session()
+        meta_graph_def = tf.saved_model.loader.load(self.session, [tf.saved_model.tag_constants.SERVING], saved_model_path)
+        signature = meta_graph_def.signature_def[tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+        self.inputs = self.session.graph.get_tensor_by_name(signature.inputs['input'].name)
+        self.outputs = self.session.graph.get_tensor_by_name(signature.outputs['output'].name)
+
+    def predict(self, x, batch_size=None):
+        batch_size = batch_size if batch_size is not None else 32
+        predictions = [self.session.run(self.outputs, feed_dict={self.inputs: x[i:i+batch_size]}) for i in range(0, len(x), batch_size)]
+        return np.concatenate(predictions, axis=0)
+
+
+def get_normalizing_model(model, per_channel_mean, per_channel_stddev):
+    # type: (keras.models.Model, np.ndarray, np.ndarray) -> keras.models.Model
+
+    """
+    Wraps the model with a uint8 input and normalizes the input in the graph
+    instead of on the CPU, the input data to transfer to the GPU is a quarter
+    of the size.
+
+    # Arguments
+        :param model: the model expecting normalized input
+        :param per_channel_mean: per-channel mean of the dataset
+        :param per_channel_stddev: per-channel standard deviation of the dataset
+    # Returns
+        :return: the model with uint8 input in range [0, 255]
+    """
+    scale, offset = image_utils.get_normalization_scale_and_offset(per_channel_mean=per_channel_mean, per_channel_stddev=per_channel_stddev)
+
+    def normalize(x):
+        return K.cast(x, K.floatx()) * K.constant(scale) + K.constant(offset)
+
+    inputs = Input(shape=model.input_shape[1:], dtype='uint8', name='uint8_input')
+    normalized_inputs = Lambda(normalize, name='normalize_input')(inputs)
+    return Model(inputs=inputs, outputs=model(normalized_inputs))
+
+
+def get_prefetch_predict_function(model, input_shape, batch_size):
+    # type: (keras.models.Model, tuple, int) -> (tf.Tensor, tf.Operation, tf.Tensor)
+
+    """
+    Builds (once per sample shape and batch size) an input pipeline that copies the
+    next batch to the GPU while the current one is being predicted, and the model
+    output on top of it. The number of samples is not part of the key, so all the
+    tiles of the same shape share a single model subgraph.
+
+    # Arguments
+        :param model: the model
+        :param input_shape: shape of the inputs to predict, including the number of samples
+        :param batch_size: batch size for the prediction
+    # Returns
+        :return: the inputs placeholder, the iterator initializer op and the model output
+    """
+    global PREFETCH_PREDICT_FUNCTIONS
+
+    sample_shape = tuple(input_shape[1:])
+    key = (sample_shape, batch_size)
+
+    if key not in PREFETCH_PREDICT_FUNCTIONS:
+        tf = K.tf
+        inputs = tf.placeholder(dtype=model.inputs[0].dtype, shape=(None,) + sample_shape)
+        dataset = tf.data.Dataset.from_tensor_slices(inputs).batch(batch_size)
+
+        # Copy the batches to the (first) GPU asynchronously if supported by the TF version
+        # and there is a GPU, otherwise only prefetch on the host
+        if hasattr(tf.contrib.data, 'prefetch_to_device') and tf.test.is_gpu_available():
+            dataset = dataset.apply(tf.contrib.data.prefetch_to_device('/gpu:0'))
+        else:
+            dataset = dataset.prefetch(1)
+
+        iterator = dataset.make_initializable_iterator()
+        outputs = model(iterator.get_next())
+        PREFETCH_PREDICT_FUNCTIONS[key] = (inputs, iterator.initializer, outputs)
+
+    return PREFETCH_PREDICT_FUNCTIONS[key]
+
+
+def predict_prefetched_batches(model, inputs, batch_size=None):
+    # type: (keras.models.Model, np.ndarray, int) -> collections.Iterable[np.ndarray]
+
+    """
+    Yields the predictions batch by batch and uploads the next batch to the GPU
+    while the previous one is being predicted.
+
+    # Arguments
+        :param model: the model
+        :param inputs: the inputs to predict
+        :param batch_size: batch size for the prediction, None uses the Keras default (32)
+    # Returns
+        :return: a generator of prediction batches
+    """
+    batch_size = batch_size if batch_size is not None else 32
+    inputs_placeholder, initializer, outputs = get_prefetch_predict_function(model, inputs.shape, batch_size)
+    session = K.get_session()
+    session.run(initializer, feed_dict={inputs_placeholder: inputs})
+
+    while True:
+        try:
+            predictions = session.run(outputs, feed_dict={K.learning_phase(): 0})
+        except K.tf.errors.OutOfRangeError:
+            break
+
+        yield predictions
+
+
+def predict_tiled(model, image_array, tile_size, tile_overlap, batch_size=None, prefetch_to_device=False, pad_to_tile_size=False):
+    # type: (keras.models.Model, np.ndarray, int, int, int, bool, bool) -> np.ndarray
+
+    """
+    Predicts the segmentation of an image by splitting it into overlapping tiles,
+    predicting the tiles in batches and stitching each batch of results into the
+    output as it is predicted by blending the overlapping regions with a Hann window.
+    Only a single batch of tile predictions is kept in memory at a time. Images that
+    fit into a single tile are predicted as is.
+
+    # Arguments
+        :param model: the model
+        :param image_array: the (normalized) image data in HxWxC format
+        :param tile_size: side length of the tiles, must fulfill the div2 constraint of the model
+        :param tile_overlap: overlap of neighbouring tiles in pixels
+        :param batch_size: batch size for the prediction, None uses the Keras default (32)
+        :param prefetch_to_device: upload the next batch of tiles to the GPU while the previous is predicted
+        :param pad_to_tile_size: reflect pad images smaller than the tile size so that all the tiles have the same shape
+    # Returns
+        :return: the prediction in HxWxC format
+    """
+
+    height, width = image_array.shape[:2]
+
+    # A model built for a fixed tile shape can only predict full tiles
+    if pad_to_tile_size and (height < tile_size or width < tile_size):
+        padding = ((0, max(tile_size - height, 0)), (0, max(tile_size - width, 0)), (0, 0))
+        padded_image_array = np.pad(image_array, padding, mode='reflect')
+        prediction = predict_tiled(model, padded_image_array, tile_size, tile_overlap, batch_size=batch_size, prefetch_to_device=prefetch_to_device)
+        return prediction[:height, :width]
+
+    if height <= tile_size and width <= tile_size:
+        return model.predict(image_array[np.newaxis, :]).squeeze()
+
+    if tile_overlap >= tile_size:
+        raise ValueError('Tile overlap must be smaller than the tile size: {} vs {}'.format(tile_overlap, tile_size))
+
+    batch_size = batch_size if batch_size is not None else 32
+    tile_height = min(tile_size, height)
+    tile_width = min(tile_size, width)
+    y_offsets = get_tile_offsets(height, tile_height, tile_size - tile_overlap)
+    x_offsets = get_tile_offsets(width, tile_width, tile_size - tile_overlap)
+    offsets = [(y, x) for y in y_offsets for x in x_offsets]
+    batch_offsets = [offsets[i:i+batch_size] for i in range(0, len(offsets), batch_size)]
+
+    print 'Predicting {} tiles of size: {} in {} batches'.format(len(offsets), (tile_height, tile_width), len(batch_offsets))
+
+    def get_tiles(tile_offsets):
+        return np.stack([image_array[y:y+tile_height, x:x+tile_width] for y, x in tile_offsets], axis=0)
+
+    # The prefetching input pipeline is fed with all the tiles at once, otherwise
+    # only one batch of tiles is built at a time
+    if prefetch_to_device:
+        tile_prediction_batches = predict_prefetched_batches(model, get_tiles(offsets), batch_size=batch_size)
+    else:
+        tile_prediction_batches = (model.predict(get_tiles(tile_offsets), batch_size=batch_size) for tile_offsets in batch_offsets)
+
+    # Drop the window end points so that the image borders covered by a single tile
+    # still have non-zero weight
+    window = np.outer(np.hanning(tile_height + 2)[1:-1], np.hanning(tile_width + 2)[1:-1]).astype(np.float32)[:, :, np.newaxis]
+
+    prediction = None
+    weights = np.zeros((height, width, 1), dtype=np.float32)
+
+    for batch_index, tile_predictions in enumerate(tile_prediction_batches):
+        if prediction is None:
+            prediction = np.zeros((height, width, tile_predictions.shape[-1]), dtype=np.float32)
+
+        for (y, x), tile_prediction in zip(batch_offsets[batch_index], tile_predictions):
+            prediction[y:y+tile_height, x:x+tile_width] += tile_prediction * window
+            weights[y:y+tile_height, x:x+tile_width] += window
+
+    prediction /= weights
+    return prediction
+
+
+def init_matplotlib(headless=False):
+    # type: (bool) -> None
+
+    """
+    Imports matplotlib, with the non-interactive Agg backend if running headless.
+
+    # Arguments
+        :param headless: use the Agg backend, plots can't be shown
+    """
+    global mpl, plt
+
+    import matplotlib
+
+    if headless:
+        matplotlib.use('Agg')
+
+    from matplotlib import pyplot
+
+    mpl = matplotlib
+    plt = pyplot
+
+
 def get_new_figure(target_width, target_height, window_title):
 
     global FIGURE_INDEX
@@ -376,7 +636,7 @@ def main():
     ap = argparse.ArgumentParser(description='Training function for material segmentation.')
     ap.add_argument('-m', '--model', required=True, type=str, help='Name of the neural network model to use')
     ap.add_argument('-c', '--config', required=True, type=str, help='Path to trainer configuration JSON file')
-    ap.add_argument('-w', '--weights', required=True, type=str, help="Path to weights directory or weights file")
+    ap.add_argument('-w', '--weights', required=True, type=str, help="Path to weights directory, weights file or SavedModel directory")
     ap.add_argument('-i', '--input', required=True, type=str, help="Path to input image")
     ap.add_argument('-t', '--gtruth', required=False, type=str, help="Path to ground truth segmentation mask")
     ap.add_argument('-o', '--output', required=False, type=str, help="Path to output image")
@@ -386,6 +646,14 @@ def main():
     ap.add_argument('--labeledonly', required=False, type=bool, default=False, help="Was the model trained using labeled only data")
     ap.add_argument('--ensembling', required=False, type=bool, default=False, help="Should we use dimensional ensembling?")
     ap.add_argument('--sdim', required=False, type=int, help='Scale to this sdim before using the image')
+    ap.add_argument('--headless', required=False, type=bool, default=False, help="Don't show the plots, only save the outputs")
+    ap.add_argument('--gpunormalization', required=False, type=bool, default=False, help="Normalize the input image in the model instead of on the CPU")
+    ap.add_argument('--fp16', required=False, type=bool, default=False, help="Run the inference in float16")
+    ap.add_argument('--xla', required=False, type=bool, default=False, help="Compile the inference graph with XLA")
+    ap.add_argument('--tilesize', required=False, type=int, help='Predict large images in batches of tiles of this size')
+    ap.add_argument('--tileoverlap', required=False, type=int, help='Overlap of the prediction tiles, defaults to quarter of the tile size')
+    ap.add_argument('--prefetch', required=False, type=bool, default=False, help="Upload the next batch of tiles to the GPU while predicting the previous")
+    ap.add_argument('--fixedtileshape', required=False, type=bool, default=False, help="Build the model for the tile shape instead of a variable input shape")
     args = vars(ap.parse_args())
 
     model_name = args['model']
@@ -400,6 +668,14 @@ def main():
     labeled_only = args['labeledonly']
     ensembling = args['ensembling']
     sdim = args['sdim']
+    headless = args['headless']
+    gpu_normalization = args['gpunormalization']
+    use_fp16 = args['fp16']
+    use_xla = args['xla']
+    tile_size = args['tilesize']
+    prefetch_to_device = args['prefetch']
+    fixed_tile_shape = args['fixedtileshape']
+    tile_overlap = args['tileoverlap'] if args['tileoverlap'] is not None else (tile_size / 4 if tile_size is not None else None)
 
     # Read the configuration file
     global CONFIG
@@ -421,6 +697,10 @@ def main():
     # Read the div2 constraint
     div2_constraint = get_config_value('div2_constraint')
 
+    # The tiles are fed to the model as is so they have to fulfill the div2 constraint
+    if tile_size is not None and dataset_utils.count_trailing_zeroes(tile_size) < div2_constraint:
+        raise ValueError('Tile size {} does not fulfill the div2 constraint: {}'.format(tile_size, div2_constraint))
+
     # Load the model
     num_classes = len(material_class_information)
     input_shape = get_config_value('input_shape')
@@ -429,56 +709,105 @@ def main():
     if ensembling and (input_shape[0] is not None and input_shape[1] is not None):
         raise ValueError('Cannot use dimensional ensembling if the input shape is not variable')
 
-    print 'Loading model {} instance with input shape: {}, num classes: {}'.format(model_name, input_shape, num_classes)
-    model_wrapper = get_model(model_name, input_shape, num_classes)
-    model = model_wrapper.model
+    # Specialize the model to the tile shape: with static shapes the shape computations are
+    # constant folded and XLA can compile the whole graph once
+    if fixed_tile_shape:
+        if tile_size is None:
+            raise ValueError('The fixedtileshape option requires a tile size')
+
+        input_shape = [tile_size, tile_size, input_shape[2]]
+
+    # The float type and the session have to be set before the model is built
+    if use_fp16:
+        print 'Using float16 for inference'
+        K.set_floatx('float16')
+        K.set_epsilon(1e-4)
+
+    if use_xla:
+        print 'Enabling XLA for Tensorflow'
+        config = K.tf.ConfigProto(allow_soft_placement=True)
+        config.graph_options.optimizer_options.global_jit_level = K.tf.OptimizerOptions.ON_1
+        K.set_session(K.tf.Session(config=config))
+
+    # Prefer a SavedModel exported with export.py - skips building the model and loading the weights
+    if is_saved_model_dir(weights_path):
+        if use_fp16 or gpu_normalization or prefetch_to_device or fixed_tile_shape:
+            raise ValueError('The fp16, gpunormalization, prefetch and fixedtileshape options are not supported with a SavedModel, use export.py --fp16 for float16')
+
+        print 'Loading SavedModel from: {}'.format(weights_path)
+        model = SavedModelPredictor(weights_path)
+    else:
+        print 'Loading model {} instance with input shape: {}, num classes: {}'.format(model_name, input_shape, num_classes)
+        model_wrapper = get_model(model_name, input_shape, num_classes)
+        model = model_wrapper.model
+
+        # Load either provided weights or try to find the newest weights from the
+        # checkpoint path
+        if os.path.isdir(weights_path):
+            print 'Searching for most recent weights in: {}'.format(weights_path)
+            weights_path = get_latest_weights_file_path(weights_path)
 
-    # Load either provided weights or try to find the newest weights from the
-    # checkpoint path
-    if os.path.isdir(weights_path):
-        print 'Searching for most recent weights in: {}'.format(weights_path)
-        weights_path = get_latest_weights_file_path(weights_path)
+        print 'Loading weights from: {}'.format(weights_path)
+        model.load_weights(weights_path)
 
-    print 'Loading weights from: {}'.format(weights_path)
-    model.load_weights(weights_path)
+    if gpu_normalization:
+        print 'Normalizing the input images in the model'
+        per_channel_mean = data_set_information.labeled_per_channel_mean if labeled_only else data_set_information.per_channel_mean
+        per_channel_stddev = data_set_information.labeled_per_channel_stddev if labeled_only else data_set_information.per_channel_stddev
+        model = get_normalizing_model(model, per_channel_mean, per_channel_stddev)
 
     # Load the image file
     print 'Using ensembling: {}'.format(ensembling)
 
-    # Create the prediction images
-    prediction_images = []
-
     # If using ensembling create the different sized versions
     if ensembling:
         # TODO: Figure out whether scale factors or or set sdim sizes are better
         ENSEMBLING_SCALE_FACTORS = [1.0/math.sqrt(2.0), 1.0, math.sqrt(2)] # [0.50, 0.75, 1.0] # [1.0, 1.5, 2.0] #
         print 'Using ensembling scale factors: {}'.format(ENSEMBLING_SCALE_FACTORS)
-
-        for sfactor in ENSEMBLING_SCALE_FACTORS:
-            prediction_images.append(
-                PredictionImage(input_image_path, data_set_information, sdim=sdim, scale_factor=sfactor, div2_constraint=div2_constraint, labeled_only=labeled_only))
+        scale_factors = ENSEMBLING_SCALE_FACTORS
     # If not using ensembling we are using only scale factor of 1.0
     else:
-        prediction_images.append(
-            PredictionImage(input_image_path, data_set_information, sdim=sdim, scale_factor=1.0, div2_constraint=div2_constraint, labeled_only=labeled_only))
+        scale_factors = [1.0]
 
+    def create_prediction_image(sfactor):
+        return PredictionImage(input_image_path, data_set_information, sdim=sdim, scale_factor=sfactor, div2_constraint=div2_constraint, labeled_only=labeled_only, normalize=not gpu_normalization)
+
+    # Create the prediction images in background threads so that loading and pre-processing
+    # the next image overlaps with the prediction of the current one
+    prediction_images = []
     predictions = []
+    preprocessing_pool = ThreadPool(processes=len(scale_factors))
 
-    for prediction_image in prediction_images:
+    for prediction_image in preprocessing_pool.imap(create_prediction_image, scale_factors):
+        prediction_images.append(prediction_image)
         print 'Predicting segmentation for image with shape: {}'.format(prediction_image.np_image.shape)
 
         # The model is expecting a batch size, even if it's one so append
         # one new dimension to the beginning to mark batch size of one - squeeze when done
         start_time = time.time()
-        prediction = model.predict(prediction_image.np_image[np.newaxis, :])
-        prediction = prediction.squeeze()
+
+        if tile_size is not None:
+            prediction = predict_tiled(model, prediction_image.np_image, tile_size, tile_overlap, batch_size=get_config_value('predict_batch_size'), prefetch_to_device=prefetch_to_device, pad_to_tile_size=fixed_tile_shape)
+        else:
+            prediction = model.predict(prediction_image.np_image[np.newaxis, :])
+            prediction = prediction.squeeze()
+
+        # Do the post-processing in float32 also when predicting in float16
+        prediction = prediction.astype(np.float32, copy=False)
+
         predictions.append(prediction)
         end_time = time.time()
 
+        # The pre-processed input is not needed anymore - release it before the next image
+        prediction_image.np_image = None
+        prediction = None
+
         print 'Prediction finished in time: {} s'.format(end_time - start_time)
 
+    preprocessing_pool.close()
+    preprocessing_pool.join()
+
     # Undo the transformations to the images: scaling and padding
-    # And apply background class prediction weight
     for i, prediction_image in enumerate(prediction_images):
         # First remove the padding from possible div2 constraint
         if prediction_image.padded:
@@ -486,8 +815,8 @@ def main():
             predictions[i] = image_utils.np_crop_image(predictions[i],
                                         prediction_image.h_pad_before,
                                         prediction_image.v_pad_before,
-                                        prediction_image.np_image.shape[1] - prediction_image.h_pad_after,
-                                        prediction_image.np_image.shape[0] - prediction_image.v_pad_after)
+                                        predictions[i].shape[1] - prediction_image.h_pad_after,
+                                        predictions[i].shape[0] - prediction_image.v_pad_after)
 
             print 'Shape after cropping: {}'.format(predictions[i].shape)
 
@@ -519,14 +848,26 @@ def main():
             raise ValueError('Image shape after undoing transformations does not match the original shape: {} vs {}'
                              .format(predictions[i].shape[:2], prediction_image.original_shape))
 
-        # Weight the background class activations to reduce the salt'n'pepper noise
-        # likely caused by the class imbalance in the training data
-        predictions[i][:, :, 0] *= background_class_prediction_weight
+    # Take the mean of all the predictions as the final prediction. Accumulate in place
+    # instead of stacking all the predictions into a new array
+    final_prediction = predictions[0]
+
+    for i in range(1, len(predictions)):
+        final_prediction += predictions[i]
+
+    if len(predictions) > 1:
+        final_prediction /= len(predictions)
 
-    # Take the mean of all the predictions as the final prediction
-    final_prediction = np.mean(np.array(predictions), axis=0)
+    del predictions[:]
+
+    # Weight the background class activations to reduce the salt'n'pepper noise
+    # likely caused by the class imbalance in the training data. The mean is linear
+    # so weighting once after averaging is equivalent to weighting each prediction.
+    if background_class_prediction_weight != 1.0:
+        final_prediction[:, :, 0] *= background_class_prediction_weight
 
     original_pil_image = prediction_images[-1].pil_image
+    original_image_array = prediction_images[-1].raw_np_image
     file_name = prediction_images[-1].file_name
 
     # Run CRF if we are using it for post-processing
@@ -534,32 +875,30 @@ def main():
     # any CRF is run
     if crf_iterations > 0:
         # Must use the unnormalized image data
-        original_image_array = img_to_array(original_pil_image)
         crf = prediction_utils.get_dcrf(original_image_array, num_classes)
 
         # Turn the output of the last convolutional layer to softmax probabilities
-        # and then to unary.
-        softmax = np_softmax(final_prediction, axis=-1)
-        softmax = softmax.transpose((2, 0, 1))
-        unary = dcrf_utils.unary_from_softmax(softmax)
-
-        # Set the unary; The inputs should be C-continious since
-        # we are using Cython wrapper
-        unary = np.ascontiguousarray(unary)
+        # and then to unary. The unary is C-continuous as required by the Cython wrapper
+        unary = prediction_utils.logits_to_unary(final_prediction)
         crf.setUnaryEnergy(unary)
 
         # Run the CRF
         print 'Running CRF for {} iterations'.format(crf_iterations)
         crf_start_time = time.time()
-        Q = crf.inference(crf_iterations)
+        Q = prediction_utils.dcrf_inference(crf, crf_iterations, tolerance=get_config_value('crf_convergence_tolerance'))
         crf_end_time = time.time()
         print 'CRF inference finished in time: {} s'.format(crf_end_time - crf_start_time)
 
-        # Reshape the outcome
-        final_prediction = np.reshape(Q, np.flip(final_prediction.shape, 0), order='A')
-        final_prediction = np.transpose(final_prediction, (2, 1, 0))
+        # Reshape the outcome from CxH*W back to HxWxC. The CRF output is column-major
+        # so the transpose is already H*WxC in memory and the reshape is only a view
+        height, width, num_channels = final_prediction.shape
+        final_prediction = np.array(Q, copy=False).T.reshape(height, width, num_channels)
+        del crf, unary
 
     flattened_predictions = prediction_utils.top_k_flattened_masks(final_prediction, top_k, material_class_information, True)
+    del final_prediction, prediction_images, original_image_array
+
+    init_matplotlib(headless=headless)
 
     if ground_truth_image_path:
         print 'Reading ground truth image from: {}'.format(ground_truth_image_path)
@@ -577,7 +916,8 @@ def main():
     build_topk_segmentation_plot(flattened_predictions, original_pil_image, file_name, output=output_path)
 
     # Show all the plots
-    plt.show()
+    if not headless:
+        plt.show()
 
     #if output_path is not None:
     #    save_topk_segmentations(flattened_predictions, output_path)
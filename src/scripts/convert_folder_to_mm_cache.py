@@ -5,19 +5,21 @@ import time
 from PIL import Image, ImageFile
 
 from ..utils import image_utils
-from src.cache import MemoryMappedImageCache, MemoryMapUpdateMode
+from src.cache import MemoryMappedImageCache, MemoryMapUpdateMode, RAW_IMAGE_FORMAT
 
 
 def main():
     ap = argparse.ArgumentParser(description="Converts a folder of images into diskcache")
     ap.add_argument("-i", "--input", type=str, required=True, help="Path to images folder")
     ap.add_argument("-o", "--cache", type=str, required=True, help="Path to output cache folder")
+    ap.add_argument("--raw", type=bool, required=False, default=False, help="Store the decoded pixel data instead of the encoded images")
     args = vars(ap.parse_args())
 
     ImageFile.LOAD_TRUNCATED_IMAGES = True
 
     input_path = args['input']
     cache_dir = args['cache']
+    save_format = RAW_IMAGE_FORMAT if args['raw'] else None
 
     print 'Reading images from: {}'.format(input_path)
     img_paths = image_utils.list_pictures(input_path)
@@ -46,7 +48,7 @@ def main():
                 continue
 
             key = os.path.basename(pil_img.filename)
-            cache.set_image_to_cache(key, pil_img)
+            cache.set_image_to_cache(key, pil_img, save_format=save_format)
 
         num_cached += 1
         etr = (num_images - num_cached) * ((time.time()-start_time) / num_cached)
@@ -22,7 +22,22 @@ CLASSIFICATION_PHOTO_TRANSFORM_INTERPOLATION_TYPE = 'bilinear'
 
 QUEUE_SIZE_REPORT_INTERVAL = None
 
+# Size in bytes of a shared memory slot used to pass a batch from the OrderedEnqueuer worker
+# processes to the trainer without pickling. Must fit the largest batch (larger batches fall
+# back to pickling). None disables the shared memory transport.
+ENQUEUER_SHARED_MEMORY_SLOT_SIZE = None
+
+# Store the resized image cache as decoded pixel data: no decoding on reads at the cost of disk space
+RESIZED_IMAGE_CACHE_SAVE_RAW = False
+
 USE_XLA = False
+# Let the TF (>= 1.14) graph rewrite run convolutions and matmuls in float16 on tensor cores,
+# the variables stay float32. Use with the optimizer loss_scale config to avoid gradient underflow.
+USE_AUTO_MIXED_PRECISION = False
+# Compile only the max unpooling ops with XLA (has no effect on top of USE_XLA)
+XLA_COMPILE_UNPOOLING = False
+# Compile only the lambda loss layer ops with XLA (has no effect on top of USE_XLA)
+XLA_COMPILE_LAMBDA_LOSS = False
 USE_MULTIPROCESSING = True
 COPY_DATASET_TO_TMP = True
 
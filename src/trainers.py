@@ -31,6 +31,7 @@ from utils import dataset_utils
 from utils import general_utils
 
 from callbacks.optimizer_checkpoint import OptimizerCheckpoint
+from callbacks.async_model_checkpoint import AsyncModelCheckpoint
 from callbacks.stepwise_learning_rate_scheduler import StepwiseLearningRateScheduler
 from generators import DataGenerator, SegmentationDataGenerator, MINCDataSet, ClassificationDataGenerator
 from generators import DataGeneratorParameters, SegmentationDataGeneratorParameters, DataAugmentationParameters
@@ -113,6 +114,12 @@ def get_tf_session():
             if settings.USE_XLA:
                 Logger.instance().log('Enabling XLA for Tensorflow')
                 config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+
+            if settings.USE_AUTO_MIXED_PRECISION:
+                from tensorflow.core.protobuf import rewriter_config_pb2
+                Logger.instance().log('Enabling automatic mixed precision for Tensorflow')
+                config.graph_options.rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+
             tensorflow_backend._SESSION = tf.Session(config=config)
         session = tensorflow_backend._SESSION
     if not tensorflow_backend._MANUAL_VAR_INIT:
@@ -204,6 +211,7 @@ class TrainerBase:
         self._initial_step = None
         self._class_weight_type = None
         self._ignore_classes = None
+        self._optimizer_configuration_cache = None
         self.last_completed_epoch = -1
 
         # Profiling related variables
@@ -439,7 +447,9 @@ class TrainerBase:
                                               self.num_classes,
                                               model_lambda_loss_type=model_lambda_loss_type)
 
-        self.model.summary()
+        # The model summary is formatted layer by layer - only write it to the log when asked for
+        if self.verbose_init:
+            self.model.summary(print_fn=self.logger.log)
 
         if self.continue_from_last_checkpoint:
             self._load_latest_weights_for_model(self.model, self.model_checkpoint_directory)
@@ -700,6 +710,11 @@ class TrainerBase:
         # type: () -> bool
         return bool(self._get_config_value('use_class_weights'))
 
+    @property
+    def verbose_init(self):
+        # type: () -> bool
+        return bool(self._get_config_value('verbose_init'))
+
     @property
     def class_weight_type(self):
         # type: () -> ClassWeightType
@@ -777,22 +792,27 @@ class TrainerBase:
     @property
     def num_training_data_generation_workers(self):
         # type: () -> int
-        return min(settings.MAX_NUMBER_OF_JOBS, settings.TRAINING_DATA_GENERATOR_WORKERS)
+        workers = self._get_config_value('training_data_generator_workers')
+        workers = workers if workers is not None else settings.TRAINING_DATA_GENERATOR_WORKERS
+        return min(settings.MAX_NUMBER_OF_JOBS, workers)
 
     @property
     def num_validation_data_generation_workers(self):
         # type: () -> int
-        return min(settings.MAX_NUMBER_OF_JOBS, settings.VALIDATION_DATA_GENERATOR_WORKERS)
+        workers = self._get_config_value('validation_data_generator_workers')
+        workers = workers if workers is not None else settings.VALIDATION_DATA_GENERATOR_WORKERS
+        return min(settings.MAX_NUMBER_OF_JOBS, workers)
 
     @property
     def training_data_max_queue_size(self):
         # type: () -> int
-        return settings.TRAINING_DATA_MAX_QUEUE_SIZE
+        # Keep at least two batches in flight per worker so that no worker idles
+        return max(settings.TRAINING_DATA_MAX_QUEUE_SIZE, 2 * self.num_training_data_generation_workers)
 
     @property
     def validation_data_max_queue_size(self):
         # type: () -> int
-        return settings.VALIDATION_DATA_MAX_QUEUE_SIZE
+        return max(settings.VALIDATION_DATA_MAX_QUEUE_SIZE, 2 * self.num_validation_data_generation_workers)
 
     @property
     def num_labeled_per_batch(self):
@@ -867,11 +887,10 @@ class TrainerBase:
 
     def _load_config_json(self, path):
         with open(path) as f:
-            data = f.read()
-            return json.loads(data)
+            return json.load(f)
 
     def _get_config_value(self, key):
-        return self.config[key] if key in self.config else None
+        return self.config.get(key)
 
     def _set_config_value(self, key, value):
         self.config[key] = value
@@ -952,13 +971,18 @@ class TrainerBase:
         keras_model_checkpoint_file_path = os.path.join(keras_model_checkpoint_dir, keras_model_checkpoint_file)
         general_utils.create_path_if_not_existing(keras_model_checkpoint_file_path)
         keras_model_checkpoint_monitor = keras_model_checkpoint.get('monitor') or 'val_loss'
-        keras_model_checkpoint_verbose = keras_model_checkpoint.get('verbose') or 1
+        keras_model_checkpoint_verbose = keras_model_checkpoint.get('verbose', 1)
         keras_model_checkpoint_save_best_only = keras_model_checkpoint.get('save_best_only') or False
         keras_model_checkpoint_save_weights_only = keras_model_checkpoint.get('save_weights_only') or False
         keras_model_checkpoint_mode = keras_model_checkpoint.get('mode') or 'auto'
         keras_model_checkpoint_period = keras_model_checkpoint.get('period') or 1
+        keras_model_checkpoint_asynchronous = keras_model_checkpoint.get('asynchronous') or False
+
+        # The asynchronous checkpoint writes the weights in a background thread so the training doesn't wait for the disk
+        model_checkpoint_class = AsyncModelCheckpoint if keras_model_checkpoint_asynchronous else ModelCheckpoint
+        self.logger.log('Using asynchronous model checkpoint writes: {}'.format(keras_model_checkpoint_asynchronous))
 
-        model_checkpoint_callback = ModelCheckpoint(
+        model_checkpoint_callback = model_checkpoint_class(
             filepath=keras_model_checkpoint_file_path,
             monitor=keras_model_checkpoint_monitor,
             verbose=keras_model_checkpoint_verbose,
@@ -974,11 +998,14 @@ class TrainerBase:
             # Tensorboard log files have unique names for each run - so no worries about overwriting
             general_utils.create_path_if_not_existing(keras_tensorboard_log_path)
 
+            # Histograms and kernel images are expensive on big networks - they are opt-in via the tensorboard config
+            tensorboard = self._get_config_value('tensorboard') or {}
+
             tensorboard_checkpoint_callback = TensorBoard(
                 log_dir=keras_tensorboard_log_path,
-                histogram_freq=0,
-                write_graph=True,
-                write_images=True,
+                histogram_freq=tensorboard.get('histogram_freq', 0),
+                write_graph=tensorboard.get('write_graph', True),
+                write_images=tensorboard.get('write_images', False),
                 write_grads=False,  # Note: writing grads for a bit network takes about an hour
                 embeddings_freq=0,
                 embeddings_layer_names=None,
@@ -1007,9 +1034,9 @@ class TrainerBase:
         # Early stopping to conserve resources
         if early_stopping is not None:
             monitor = early_stopping.get('monitor') or 'val_loss'
-            min_delta = early_stopping.get('min_delta') or 0.0
-            patience = early_stopping.get('patience') or 2
-            verbose = early_stopping.get('verbose') or 0
+            min_delta = early_stopping.get('min_delta', 0.0)
+            patience = early_stopping.get('patience', 2)
+            verbose = early_stopping.get('verbose', 0)
             mode = early_stopping.get('mode') or 'auto'
 
             early_stop = EarlyStopping(
@@ -1023,12 +1050,12 @@ class TrainerBase:
 
         # Reduce LR on plateau to adjust learning rate
         if reduce_lr_on_plateau is not None:
-            factor = reduce_lr_on_plateau.get('factor') or 0.1
-            patience = reduce_lr_on_plateau.get('patience') or 10
-            min_lr = reduce_lr_on_plateau.get('min_lr') or 0
-            epsilon = reduce_lr_on_plateau.get('epsilon') or 0.0001
-            cooldown = reduce_lr_on_plateau.get('cooldown') or 0
-            verbose = reduce_lr_on_plateau.get('verbose') or 0
+            factor = reduce_lr_on_plateau.get('factor', 0.1)
+            patience = reduce_lr_on_plateau.get('patience', 10)
+            min_lr = reduce_lr_on_plateau.get('min_lr', 0)
+            epsilon = reduce_lr_on_plateau.get('epsilon', 0.0001)
+            cooldown = reduce_lr_on_plateau.get('cooldown', 0)
+            verbose = reduce_lr_on_plateau.get('verbose', 0)
             monitor = reduce_lr_on_plateau.get('monitor') or 'val_loss'
 
             reduce_lr = ReduceLROnPlateau(
@@ -1079,15 +1106,21 @@ class TrainerBase:
             self.logger.warn('Cannot continue from optimizer checkpoint if initial epoch is 0. Ignoring optimizer checkpoint.')
         elif self.continue_from_optimizer_checkpoint and self.initial_epoch != 0:
             optimizer_configuration_file_path = self.optimizer_checkpoint_file_path
-            self.logger.log('Loading optimizer configuration from file: {}'.format(optimizer_configuration_file_path))
 
-            try:
-                with open(optimizer_configuration_file_path, 'r') as f:
-                    data = f.read()
-                    optimizer_configuration = json.loads(data)
-            except (IOError, ValueError) as e:
-                self.logger.log('Could not load optimizer configuration from file: {}, error: {}. Continuing without config.'.format(optimizer_configuration_file_path, e.message))
-                optimizer_configuration = None
+            # The student and teacher optimizers are created from the same file - only read it once
+            if self._optimizer_configuration_cache is not None and self._optimizer_configuration_cache[0] == optimizer_configuration_file_path:
+                self.logger.log('Using cached optimizer configuration from file: {}'.format(optimizer_configuration_file_path))
+                optimizer_configuration = dict(self._optimizer_configuration_cache[1])
+            else:
+                self.logger.log('Loading optimizer configuration from file: {}'.format(optimizer_configuration_file_path))
+
+                try:
+                    with open(optimizer_configuration_file_path, 'r') as f:
+                        optimizer_configuration = json.load(f)
+                        self._optimizer_configuration_cache = (optimizer_configuration_file_path, dict(optimizer_configuration))
+                except (IOError, ValueError) as e:
+                    self.logger.log('Could not load optimizer configuration from file: {}, error: {}. Continuing without config.'.format(optimizer_configuration_file_path, e.message))
+                    optimizer_configuration = None
 
         if optimizer_name == 'adam':
             if optimizer_configuration is not None:
@@ -1095,7 +1128,8 @@ class TrainerBase:
             else:
                 lr = optimizer_info['learning_rate']
                 decay = optimizer_info['decay']
-                optimizer = Adam(lr=lr, decay=decay, lr_scalers=lr_scalers)
+                loss_scale = optimizer_info.get('loss_scale', 1.0)
+                optimizer = Adam(lr=lr, decay=decay, lr_scalers=lr_scalers, loss_scale=loss_scale)
 
             self.logger.log('Using {} optimizer with learning rate: {}, decay: {}, beta_1: {}, beta_2: {}'
                 .format(optimizer.__class__.__name__,
@@ -1111,7 +1145,8 @@ class TrainerBase:
                 lr = optimizer_info['learning_rate']
                 decay = optimizer_info['decay']
                 momentum = optimizer_info['momentum']
-                optimizer = SGD(lr=lr, momentum=momentum, decay=decay, lr_scalers=lr_scalers)
+                loss_scale = optimizer_info.get('loss_scale', 1.0)
+                optimizer = SGD(lr=lr, momentum=momentum, decay=decay, lr_scalers=lr_scalers, loss_scale=loss_scale)
 
             self.logger.log('Using {} optimizer with learning rate: {}, momentum: {}, decay: {}'
                 .format(optimizer.__class__.__name__,
@@ -1311,6 +1346,9 @@ class TrainerBase:
             K.tf.train.write_graph(K.get_session().graph_def, graph_def_file_folder, "graph_def", as_text=True)
             self.logger.profile_log('Writing Tensorflow GraphDef complete')
 
+        # Make sure the initialization logs are on disk before the training starts
+        self.logger.flush_log()
+
     def modify_batch_data(self, step_index, x, y, validation=False):
         # type: (int, list, list, bool) -> (list, list)
         assert isinstance(x, list)
@@ -1335,6 +1373,7 @@ class TrainerBase:
 
     def on_epoch_end(self, epoch_index, step_index, logs):
         self.last_completed_epoch = epoch_index
+        self.logger.flush_log()
 
     def on_training_end(self):
         if settings.PROFILE:
@@ -1417,6 +1456,10 @@ class MeanTeacherTrainerBase(TrainerBase):
         self._consistency_cost_coefficient_function = None
         self._teacher_weights_directory_path = None
         self._teacher_model_checkpoint_file_path = None
+        self._ema_update_function = None
+        self._teacher_validation_outs = None
+        self._teacher_validation_batch_sizes = None
+        self._consistency_coefficients_buffer = None
 
         super(MeanTeacherTrainerBase, self).__init__(trainer_type=trainer_type, model_name=model_name, model_folder_name=model_folder_name, config_file_path=config_file_path)
 
@@ -1435,7 +1478,9 @@ class MeanTeacherTrainerBase(TrainerBase):
     def _pre_create_enqueuers(self):
         super(MeanTeacherTrainerBase, self)._pre_create_enqueuers()
 
-        if self.using_mean_teacher_method:
+        # The teacher is evaluated on the student validation batches, the separate teacher
+        # validation data is only used as a fallback when the student doesn't validate
+        if self.using_mean_teacher_method and self.validation_steps_per_epoch <= 0:
             self.logger.log('Pre-creating teacher validation enqueuer to avoid copying Tensorflow computational graph during process creation')
             self._teacher_validation_data_enqueuer = ExtendedModel\
                 .pre_create_validation_enqueuer(generator=self.teacher_validation_data_iterator,
@@ -1453,7 +1498,9 @@ class MeanTeacherTrainerBase(TrainerBase):
 
             self.logger.log('Creating teacher model {} instance with lambda loss type: {}, input shape: {}, num classes: {}'.format(self.model_name, teacher_model_lambda_loss_type, self.input_shape, self.num_classes))
             self.teacher_model_wrapper = models.get_model(self.model_name, self.input_shape, self.num_classes, model_lambda_loss_type=teacher_model_lambda_loss_type)
-            self.teacher_model.summary()
+
+            if self.verbose_init:
+                self.teacher_model.summary(print_fn=self.logger.log)
 
             if self.continue_from_last_checkpoint:
                 self.logger.log('Loading latest teacher model weights from path: {}'.format(self.teacher_weights_directory_path))
@@ -1639,6 +1686,11 @@ class MeanTeacherTrainerBase(TrainerBase):
 
         # Append mean teacher data
         if self.using_mean_teacher_method:
+            # Evaluate the teacher on the same validation batch as the student so the
+            # validation data is only generated once per epoch
+            if validation:
+                self._test_teacher_on_validation_batch(step_index=step_index, x=x, y=y)
+
             img_batch = x[0]
             labels_data = x[1]
 
@@ -1690,21 +1742,35 @@ class MeanTeacherTrainerBase(TrainerBase):
                 self.logger.warn('Out of bounds EMA coefficient value when updating teacher weights: {}'.format(a))
 
             # Perform the EMA weight update: theta'_t = a * theta'_t-1 + (1 - a) * theta_t
-            t_weights = self.teacher_model.get_weights()
-            s_weights = self.model.get_weights()
+            s_time = time.time()
+            self.ema_update_function([a])
+            self.logger.profile_log('Mean teacher weight update took: {} s'.format(time.time() - s_time))
+
+    @property
+    def ema_update_function(self):
+        # type: () -> K.Function
+
+        """
+        Returns a backend function that performs the mean teacher EMA weight update
+        theta'_t = a * theta'_t-1 + (1 - a) * theta_t with assign ops in the graph, so
+        the weights never leave the device. The only input is the EMA coefficient a.
+
+        # Returns
+            :return: the EMA update function
+        """
+        if self._ema_update_function is None:
+            t_weights = self.teacher_model.weights
+            s_weights = self.model.weights
 
             if len(t_weights) != len(s_weights):
                 raise ValueError('The weight arrays are not of the same length for the student and teacher: {} vs {}'
                                  .format(len(t_weights), len(s_weights)))
 
-            num_weights = len(t_weights)
-            s_time = time.time()
-
-            for i in xrange(0, num_weights):
-                t_weights[i] = a * t_weights[i] + ((1.0 - a) * s_weights[i])
+            a = K.placeholder(shape=(), dtype=K.floatx(), name='ema_smoothing_coefficient')
+            updates = [K.update(t_w, a * t_w + (1.0 - a) * s_w) for t_w, s_w in zip(t_weights, s_weights)]
+            self._ema_update_function = K.function([a], [], updates=updates)
 
-            self.teacher_model.set_weights(t_weights)
-            self.logger.profile_log('Mean teacher weight update took: {} s'.format(time.time() - s_time))
+        return self._ema_update_function
 
     def on_epoch_end(self, epoch_index, step_index, logs):
         # type: (int, int, dict) -> ()
@@ -1731,7 +1797,14 @@ class MeanTeacherTrainerBase(TrainerBase):
             # Default to -1.0 validation loss if nothing else is given
             val_loss = -1.0
 
-            if self.teacher_validation_data_generator is not None and self.teacher_validation_data_iterator is not None:
+            val_outs = None
+
+            if self._teacher_validation_outs is not None:
+                # The teacher was evaluated alongside the student validation batches
+                val_outs = self.teacher_model.average_evaluation_outs(self._teacher_validation_outs, self._teacher_validation_batch_sizes)
+                self._teacher_validation_outs = None
+                self._teacher_validation_batch_sizes = None
+            elif self.teacher_validation_data_generator is not None and self.teacher_validation_data_iterator is not None:
                 # Evaluate the mean teacher on the validation data
                 val_outs = self.teacher_model.evaluate_generator(
                     generator=self.teacher_validation_data_iterator,
@@ -1742,6 +1815,7 @@ class MeanTeacherTrainerBase(TrainerBase):
                     max_queue_size=self.validation_data_max_queue_size,
                     random_seed=self.random_seed)
 
+            if val_outs is not None:
                 # Parse all validation metrics to a single string
                 val_outs_str = ""
 
@@ -1767,6 +1841,54 @@ class MeanTeacherTrainerBase(TrainerBase):
                                     self.consistency_cost_coefficient_function(step_index)))
             self.save_teacher_model_weights(epoch_index=epoch_index, val_loss=val_loss)
 
+    def _test_teacher_on_validation_batch(self, step_index, x, y):
+        # type: (int, list[np.ndarray], list[np.ndarray]) -> ()
+
+        """
+        Runs test_on_batch for the teacher model on a student validation batch and stores
+        the outputs until the end of the epoch.
+
+        # Arguments
+            :param step_index: the validation step index
+            :param x: student validation input data
+            :param y: student validation output data
+        # Returns
+            Nothing
+        """
+        if self.teacher_model is None:
+            raise ValueError('Teacher model is not set, cannot run validation')
+
+        teacher_x, teacher_y = self._get_teacher_validation_batch(x, y)
+
+        # Reset the (streaming) metrics at the beginning of the validation run
+        if step_index == 0 or self._teacher_validation_outs is None:
+            self.teacher_model.reset_metrics()
+            self._teacher_validation_outs = []
+            self._teacher_validation_batch_sizes = []
+
+        s_time = time.time()
+        outs = self.teacher_model.test_on_batch(teacher_x, teacher_y)
+        self.logger.profile_log('Mean teacher validation batch took: {} s'.format(time.time() - s_time))
+
+        self._teacher_validation_outs.append(outs)
+        self._teacher_validation_batch_sizes.append(teacher_x[0].shape[0])
+
+    def _get_teacher_validation_batch(self, x, y):
+        # type: (list[np.ndarray], list[np.ndarray]) -> (list[np.ndarray], list[np.ndarray])
+
+        """
+        Converts a semi-supervised student validation batch [X, Y, W, num_unlabeled], [dummy, labels]
+        into the supervised batch data format of the teacher model: [X], [labels]. The validation
+        batches have no unlabeled data.
+
+        # Arguments
+            :param x: student validation input data
+            :param y: student validation output data
+        # Returns
+            :return: a tuple of (teacher input data, teacher output data)
+        """
+        return [x[0]], [y[1]]
+
     def save_teacher_model_weights(self, epoch_index, val_loss, file_extension=''):
         # type: (int, float, str) -> None
 
@@ -1858,7 +1980,13 @@ class MeanTeacherTrainerBase(TrainerBase):
             mean_teacher_predictions = self.teacher_model.predict_on_batch(teacher_img_batch, use_training_phase_layers=True)
             self.logger.profile_log('Mean teacher batch predictions took: {} s'.format(time.time() - s_time))
             consistency_coefficient = self.consistency_cost_coefficient_function(step_index)
-            np_consistency_coefficients = np.ones(shape=[batch_size]) * consistency_coefficient
+
+            # Reuse the coefficient buffer between steps, only reallocate if the batch size changes
+            if self._consistency_coefficients_buffer is None or self._consistency_coefficients_buffer.shape[0] != batch_size:
+                self._consistency_coefficients_buffer = np.empty(shape=[batch_size], dtype=np.float32)
+
+            np_consistency_coefficients = self._consistency_coefficients_buffer
+            np_consistency_coefficients.fill(consistency_coefficient)
 
             if teacher_data_shape != list(mean_teacher_predictions.shape):
                 self.logger.warn('Mismatch between teacher data shape and returned MT predictions: {} vs {}'
@@ -2464,11 +2592,11 @@ class SegmentationTrainer(MeanTeacherTrainerBase):
             return []
 
         if validation:
-            np_unlabeled_cost_coefficients = np.zeros(shape=[batch_size])
+            np_unlabeled_cost_coefficients = np.zeros(shape=[batch_size], dtype=np.float32)
             return [np_unlabeled_cost_coefficients]
         else:
             unlabeled_cost_coefficient = self.superpixel_unlabeled_cost_coefficient_function(step_index)
-            np_unlabeled_cost_coefficients = np.ones(shape=[batch_size]) * unlabeled_cost_coefficient
+            np_unlabeled_cost_coefficients = np.full(shape=[batch_size], fill_value=unlabeled_cost_coefficient, dtype=np.float32)
             return [np_unlabeled_cost_coefficients]
 
     def _get_superpixel_label_generation_function_type(self, label_generation_function_name):
@@ -1,7 +1,6 @@
 # coding=utf-8
 
 import os
-import random
 import multiprocessing
 import time
 
@@ -1255,17 +1254,13 @@ def split_labeled_dataset(photo_files, mask_files, split, random_seed):
     photo_files.sort()
     mask_files.sort()
 
-    # Zip the lists to create a list of matching photo - mask file tuples
-    photo_mask_files = zip(photo_files, mask_files)
-
-    # Shuffle the list of files
-    random.seed(random_seed)
+    # Shuffle the indices of the matching photo - mask file pairs
     np.random.seed(random_seed)
-    random.shuffle(photo_mask_files)
+    dataset_size = len(photo_files)
+    shuffled_indices = np.random.permutation(dataset_size)
 
     # Divide the dataset to three different parts: training, validation and test
     # according to the given split: 0=training, 1=validation, 2=test
-    dataset_size = len(photo_mask_files)
     training_set_size = int(round(split[0] * dataset_size))
     validation_set_size = int(round(split[1] * dataset_size))
     test_set_size = int(round(split[2] * dataset_size))
@@ -1284,9 +1279,10 @@ def split_labeled_dataset(photo_files, mask_files, split, random_seed):
         raise ValueError('The split set sizes do not sum to total dataset size: {} + {} + {} = {} != {}'
                          .format(training_set_size, validation_set_size, test_set_size, total_size, dataset_size))
 
-    training_set = photo_mask_files[0:training_set_size]
-    validation_set = photo_mask_files[training_set_size:training_set_size + validation_set_size]
-    test_set = photo_mask_files[training_set_size + validation_set_size:]
+    # Create lists of matching photo - mask file tuples
+    training_set = [(photo_files[i], mask_files[i]) for i in shuffled_indices[0:training_set_size]]
+    validation_set = [(photo_files[i], mask_files[i]) for i in shuffled_indices[training_set_size:training_set_size + validation_set_size]]
+    test_set = [(photo_files[i], mask_files[i]) for i in shuffled_indices[training_set_size + validation_set_size:]]
 
     return training_set, validation_set, test_set
 
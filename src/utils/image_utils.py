@@ -1,6 +1,5 @@
 # coding=utf-8
 
-import copy
 import os
 import re
 import time
@@ -153,6 +152,37 @@ def img_to_array(img, data_format=None, dtype=None):
     return x
 
 
+def imgs_to_array_batch(imgs, data_format=None, dtype=None):
+    """Converts a list of equally sized PIL Image instances to a single 4D Numpy array.
+
+    8-bit images are read in their native pixel type and written straight into
+    the preallocated batch, which avoids a temporary float array per image and
+    the extra copy of stacking a list of arrays.
+
+    # Arguments
+        imgs: list of PIL Image instances.
+        data_format: Image data format.
+        dtype: dtype of the batch, defaults to settings.DEFAULT_NUMPY_FLOAT_DTYPE.
+
+    # Returns
+        A 4D Numpy array.
+    """
+    if dtype is None:
+        dtype = settings.DEFAULT_NUMPY_FLOAT_DTYPE
+
+    batch = None
+
+    for i, img in enumerate(imgs):
+        x = img_to_array(img, data_format=data_format, dtype=np.uint8 if img.mode in ('L', 'P', 'RGB', 'RGBA') else dtype)
+
+        if batch is None:
+            batch = np.empty((len(imgs),) + x.shape, dtype=dtype)
+
+        batch[i] = x
+
+    return batch
+
+
 def load_img(path, grayscale=False, target_size=None, num_read_attemps=1, load_to_memory=False):
     """Loads an image into PIL format.
 
@@ -1415,23 +1445,19 @@ def np_pad_image(np_img, v_pad_before, v_pad_after, h_pad_before, h_pad_after, c
         :return: the padded version of the image
     """
 
-    # Temporary value for cval for simplicity
-    temp_cval = 919191.0
-
-    np_img = np.pad(np_img, [(v_pad_before, v_pad_after), (h_pad_before, h_pad_after), (0, 0)], 'constant', constant_values=temp_cval)
-
-    # Create a mask for all the temporary cvalues
-    if np_img.ndim == 3:
-        cval_mask = np_img[:, :, 0] == temp_cval
-    elif np_img.ndim == 2:
-        cval_mask = np_img[:, :] == temp_cval
-    else:
+    if np_img.ndim != 3 and np_img.ndim != 2:
         raise ValueError('Unsupported number of dimensions: {}'.format(np_img.ndim))
 
-    # Replace the temporary cvalues with real color values
-    np_img[cval_mask] = cval
+    height, width = np_img.shape[:2]
+    padded_shape = (height + v_pad_before + v_pad_after, width + h_pad_before + h_pad_after) + np_img.shape[2:]
 
-    return np_img
+    # Fill with the color value and copy the image in the middle, works
+    # for any dtype unlike padding with a temporary value
+    padded_img = np.empty(padded_shape, dtype=np_img.dtype)
+    padded_img[:] = cval
+    padded_img[v_pad_before:v_pad_before+height, h_pad_before:h_pad_before+width] = np_img
+
+    return padded_img
 
 
 def np_from_255_to_normalized(val):
@@ -1448,46 +1474,35 @@ def np_from_normalized_to_255(val):
     return ((val+1.0)/2.0) * 255.0
 
 
-def np_normalize_image_channels(img_array, per_channel_mean=None, per_channel_stddev=None, clamp_to_range=False, inplace=False):
-    # type: (np.ndarray, np.ndarray, np.ndarray, bool, bool) -> np.ndarray
+def get_normalization_scale_and_offset(per_channel_mean=None, per_channel_stddev=None):
+    # type: (np.ndarray, np.ndarray) -> (np.ndarray, np.ndarray)
 
     """
-    Normalizes the color channels from the given image to zero-centered
-    range [-1, 1] from the original [0, 255] range. If the per channels
-    mean is provided it is subtracted from the image after zero-centering.
-    Furthermore if the per channel standard deviation is given it is
-    used to normalize each feature value to a z-score by dividing the given
-    data.
+    Returns the per-channel scale and offset that normalize an image from the
+    [0, 255] range as in np_normalize_image_channels i.e. normalized = x * scale + offset.
 
     # Arguments
-        :param img_array: image to normalize, channels in range [0, 255]
-        :param per_channel_mean: per-channel mean of the dataset in range [-1, 1]
-        :param per_channel_stddev: per-channel standard deviation in range [-1, 1]
-        :param clamp_to_range: should the values be clamped to range [-1, 1]
-        :param inplace: should we modify the passed value or create a copy
+        :param per_channel_mean: per-channel mean of the dataset in range [-1, 1] or [0, 255]
+        :param per_channel_stddev: per-channel standard deviation in range [-1, 1] or [0, 255]
     # Returns
-        :returns: the normalized image with channels in  range [-1, 1]
+        :return: a tuple of float32 (scale, offset)
     """
-    if inplace:
-        normalized_img_array = img_array.astype(np.float32)
-    else:
-        normalized_img_array = copy.deepcopy(img_array).astype(np.float32)
 
-    if np.min(normalized_img_array) < 0 or np.max(normalized_img_array) > 255:
-        raise ValueError('Image values are not in range [0, 255], got [{}, {}]'.format(np.min(normalized_img_array), np.max(normalized_img_array)))
-
-    normalized_img_array = ((normalized_img_array/255.0) - 0.5) * 2.0
+    # Fold the [0, 255] -> [-1, 1] scaling, mean subtraction and stddev division into
+    # a single per-channel scale and offset: ((x/127.5 - 1) - mean) / stddev
+    scale = np.float32(1.0/127.5)
+    offset = np.float32(-1.0)
 
     # Subtract the per-channel-mean from the batch to "center" the data.
     if per_channel_mean is not None:
-        _per_channel_mean = np.array(per_channel_mean).astype(np.float32)
+        _per_channel_mean = np.asarray(per_channel_mean, dtype=np.float32)
 
         # Per channel mean is in range [-1,1]
         if (_per_channel_mean >= -1.0 - 1e-7).all() and (_per_channel_mean <= 1.0 + 1e-7).all():
-            normalized_img_array -= _per_channel_mean
+            offset = offset - _per_channel_mean
         # Per channel mean is in range [0, 255]
         elif (_per_channel_mean >= 0.0).all() and (_per_channel_mean <= 255.0).all():
-            normalized_img_array -= np_from_255_to_normalized(_per_channel_mean)
+            offset = offset - np_from_255_to_normalized(_per_channel_mean)
         else:
             raise ValueError('Per channel mean is in unknown range: {}'.format(_per_channel_mean))
 
@@ -1495,17 +1510,58 @@ def np_normalize_image_channels(img_array, per_channel_mean=None, per_channel_st
     # that feature or pixel as well if you want to normalize each feature
     # value to a z-score.
     if per_channel_stddev is not None:
-        _per_channel_stddev = np.array(per_channel_stddev).astype(np.float32)
+        _per_channel_stddev = np.asarray(per_channel_stddev, dtype=np.float32)
 
         # Per channel stddev is in range [-1, 1]
         if (_per_channel_stddev >= -1.0 - 1e-7).all() and (_per_channel_stddev <= 1.0 + 1e-7).all():
-            normalized_img_array /= _per_channel_stddev
+            pass
         # Per channel stddev is in range [0, 255]
         elif (_per_channel_stddev >= 0.0).all() and (_per_channel_stddev <= 255.0).all():
-            normalized_img_array /= np_from_255_to_normalized(_per_channel_stddev)
+            _per_channel_stddev = np_from_255_to_normalized(_per_channel_stddev)
         else:
             raise ValueError('Per-channel stddev is in unknown range: {}'.format(_per_channel_stddev))
 
+        scale = scale / _per_channel_stddev
+        offset = offset / _per_channel_stddev
+
+    return scale, offset
+
+
+def np_normalize_image_channels(img_array, per_channel_mean=None, per_channel_stddev=None, clamp_to_range=False, inplace=False):
+    # type: (np.ndarray, np.ndarray, np.ndarray, bool, bool) -> np.ndarray
+
+    """
+    Normalizes the color channels from the given image to zero-centered
+    range [-1, 1] from the original [0, 255] range. If the per channels
+    mean is provided it is subtracted from the image after zero-centering.
+    Furthermore if the per channel standard deviation is given it is
+    used to normalize each feature value to a z-score by dividing the given
+    data.
+
+    # Arguments
+        :param img_array: image to normalize, channels in range [0, 255]
+        :param per_channel_mean: per-channel mean of the dataset in range [-1, 1]
+        :param per_channel_stddev: per-channel standard deviation in range [-1, 1]
+        :param clamp_to_range: should the values be clamped to range [-1, 1]
+        :param inplace: should we modify the passed value or create a copy
+    # Returns
+        :returns: the normalized image with channels in  range [-1, 1]
+    """
+    # uint8 images are always in range
+    if img_array.dtype != np.uint8 and (np.min(img_array) < 0 or np.max(img_array) > 255):
+        raise ValueError('Image values are not in range [0, 255], got [{}, {}]'.format(np.min(img_array), np.max(img_array)))
+
+    scale, offset = get_normalization_scale_and_offset(per_channel_mean=per_channel_mean, per_channel_stddev=per_channel_stddev)
+
+    # Cast and scale in one pass, only modify the passed array if allowed and already float32
+    if inplace and img_array.dtype == np.float32:
+        normalized_img_array = img_array
+        normalized_img_array *= scale
+    else:
+        normalized_img_array = np.multiply(img_array, scale, dtype=np.float32)
+
+    normalized_img_array += offset
+
     if clamp_to_range:
         min_val = np.min(normalized_img_array)
         max_val = np.max(normalized_img_array)
@@ -1514,7 +1570,11 @@ def np_normalize_image_channels(img_array, per_channel_mean=None, per_channel_st
             print 'WARNING: Values outside of range [-1.0, 1.0] were found after normalization - clipping: [{}, {}]'.format(min_val, max_val)
             normalized_img_array = np.clip(normalized_img_array, -1.0, 1.0, out=normalized_img_array)
 
-    # Sanity check for the image values, we shouldn't have any NaN or inf values
+    # Sanity check for the image values, we shouldn't have any NaN or inf values. Integer
+    # images can only produce them through a non-finite scale or offset
+    if np.issubdtype(img_array.dtype, np.integer) and np.all(np.isfinite(scale)) and np.all(np.isfinite(offset)):
+        return normalized_img_array
+
     if np.any(np.isnan(normalized_img_array)):
         raise ValueError('NaN values found in image after normalization')
 
@@ -52,7 +52,8 @@ class MultiprocessingManager(object):
     _SHARED_DICTS = {}
 
     def __init__(self):
-        MultiprocessingManager._MANAGER = multiprocessing.Manager()
+        # Note: the Manager server process is only started if a shared dict is requested,
+        # the client uuids are plain shared memory values
         MultiprocessingManager._NEXT_CLIENT_UUID = multiprocessing.Value('i', 0)
         MultiprocessingManager._NUM_CURRENT_CLIENTS = multiprocessing.Value('i', 0)
         MultiprocessingManager._INSTANCE = self
@@ -73,6 +74,9 @@ class MultiprocessingManager(object):
     @property
     def manager(self):
         # type: () -> multiprocessing.Manager
+        if MultiprocessingManager._MANAGER is None:
+            MultiprocessingManager._MANAGER = multiprocessing.Manager()
+
         return MultiprocessingManager._MANAGER
 
     def get_new_client_uuid(self):
@@ -86,6 +90,6 @@ class MultiprocessingManager(object):
         # type: () -> dict
 
         if client_uuid not in MultiprocessingManager._SHARED_DICTS:
-            MultiprocessingManager._SHARED_DICTS[client_uuid] = MultiprocessingManager._MANAGER.dict()
+            MultiprocessingManager._SHARED_DICTS[client_uuid] = self.manager.dict()
 
         return MultiprocessingManager._SHARED_DICTS[client_uuid]
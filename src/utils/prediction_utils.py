@@ -24,34 +24,28 @@ def predictions_to_image(predictions, material_class_information, verbose=False)
     # Returns
         :return: the predictions as a flattened image and a list of found materials and their percentages
     """
-    flattened_mask = np.zeros(shape=(predictions.shape[0], predictions.shape[1], 3), dtype='uint8')
-    found_materials = []
-    image_pixels = float(predictions.shape[0] * predictions.shape[1])
+    # Build a color palette indexed by the material class id and map all the pixels
+    # to their material colors with a single gather. Unknown ids are mapped to black.
+    num_material_ids = max(max(material_class.id for material_class in material_class_information), np.max(predictions)) + 1
+    palette = np.zeros(shape=(num_material_ids, 3), dtype='uint8')
 
     for material_class in material_class_information:
-        material_class_id = material_class.id
-
-        # Select all the pixels with the corresponding id values
-        class_mask = predictions[:, :] == material_class_id
-
-        # Set all the corresponding pixels in the flattened image
-        # to the material color. If there are many colors for one
-        # material, select the first to represent them all.
-        # material_r_color = material_class.r_color_values[0]
+        palette[material_class.id] = material_class.color
 
-        # Parse a unique color for the material
-        color = material_class.color
+    flattened_mask = palette[predictions]
+    found_materials = []
 
-        if verbose and np.any(class_mask):
-            percentage = (float(np.sum(class_mask)) / image_pixels) * 100.0
-            print 'Found material: {}, in {}% of the pixels. Assigning it color: {}' \
-                .format(material_class.name, percentage, color)
-            found_materials.append((material_class, percentage))
+    if verbose:
+        image_pixels = float(predictions.shape[0] * predictions.shape[1])
+        material_pixels = np.bincount(predictions.ravel(), minlength=num_material_ids)
 
-            # Assign the material color to all the masked pixels
-            flattened_mask[class_mask] = color
+        for material_class in material_class_information:
+            if material_pixels[material_class.id] > 0:
+                percentage = (float(material_pixels[material_class.id]) / image_pixels) * 100.0
+                print 'Found material: {}, in {}% of the pixels. Assigning it color: {}' \
+                    .format(material_class.name, percentage, material_class.color)
+                found_materials.append((material_class, percentage))
 
-    if verbose:
         print 'Found in total {} materials'.format(len(found_materials))
 
     return flattened_mask, found_materials
@@ -91,12 +85,19 @@ def top_k_flattened_masks(expanded_mask, k, material_class_information, verbose=
     """
 
     flattened_masks = []
+    height, width, num_classes = expanded_mask.shape
+    k = min(k, num_classes)
+
+    # Get the top k predictions: partition the k largest to the end of each pixel's
+    # class axis and sort only those in descending order
+    flat_mask = expanded_mask.reshape(-1, num_classes)
+    pixel_indices = np.arange(flat_mask.shape[0])[:, np.newaxis]
+    top_k_indices = np.argpartition(flat_mask, num_classes - k, axis=-1)[:, num_classes - k:]
+    top_k_order = np.argsort(-flat_mask[pixel_indices, top_k_indices], axis=-1)
+    top_k_indices = top_k_indices[pixel_indices, top_k_order]
 
-    # Get the top k predictions
-    top_k_predictions = np.argsort(-expanded_mask)
-    top_k_predictions = np.transpose(top_k_predictions)
-    top_k_predictions = top_k_predictions[:k]
-    top_k_predictions = np.transpose(top_k_predictions, axes=(0, 2, 1))
+    # In kxHxW form
+    top_k_predictions = top_k_indices.T.reshape(k, height, width)
 
     for i in range(0, k):
         print 'Processing top {} segmentation'.format(i + 1)
@@ -105,6 +106,42 @@ def top_k_flattened_masks(expanded_mask, k, material_class_information, verbose=
     return flattened_masks
 
 
+def logits_to_unary(expanded_mask, clip=1e-5):
+    # type: (np.array, float) -> np.array
+
+    """
+    Turns the logits in expanded HxWxNUM_CLASSES form into the negative log softmax
+    probability unary expected by the dense CRF. Equivalent to softmax -> transpose ->
+    pydensecrf.utils.unary_from_softmax -> ascontiguousarray but writes the CxH*W output
+    in a single allocation and works on it in-place.
+
+    # Arguments
+        :param expanded_mask: the logits in expanded HxWxNUM_CLASSES form
+        :param clip: minimum probability, limits the maximum value of the unary
+    # Returns
+        :return: C-contiguous float32 unary in NUM_CLASSESxH*W form
+    """
+    num_classes = expanded_mask.shape[-1]
+    unary = np.empty((num_classes,) + expanded_mask.shape[:-1], dtype=np.float32)
+    np.copyto(unary, np.rollaxis(expanded_mask, -1), casting='same_kind')
+
+    # log(softmax) = x - max - log(sum(exp(x - max))), accumulate the sum one
+    # channel at a time to avoid an exp temporary of the full size
+    unary -= np.max(unary, axis=0)
+    exp_sum = np.zeros(unary.shape[1:], dtype=np.float32)
+
+    for c in range(0, num_classes):
+        exp_sum += np.exp(unary[c])
+
+    unary -= np.log(exp_sum)
+
+    # Negate and clip: -log(max(p, clip)) == min(-log(p), -log(clip))
+    np.negative(unary, out=unary)
+    np.minimum(unary, -np.log(clip), out=unary)
+
+    return unary.reshape(num_classes, -1)
+
+
 def get_dcrf(img, nlabels):
     width = img.shape[1]
     height = img.shape[0]
@@ -135,3 +172,37 @@ def get_dcrf(img, nlabels):
                         normalization=dcrf.NORMALIZE_SYMMETRIC)
 
     return d
+
+
+def dcrf_inference(crf, max_iterations, tolerance=None):
+    # type: (dcrf.DenseCRF2D, int, float) -> np.array
+
+    """
+    Runs the mean-field inference of the dense CRF. If a tolerance is given
+    the inference is stopped early once the maximum absolute change of the
+    marginals between two iterations falls below it.
+
+    # Arguments
+        :param crf: the dense CRF with the unary and pairwise energies set
+        :param max_iterations: maximum number of iterations
+        :param tolerance: convergence tolerance, None runs all the iterations
+    # Returns
+        :return: the marginals in NUM_CLASSESxH*W form
+    """
+    if tolerance is None:
+        return np.array(crf.inference(max_iterations), copy=False)
+
+    Q, tmp1, tmp2 = crf.startInference()
+    prev_Q = np.array(Q)
+
+    for i in range(0, max_iterations):
+        crf.stepInference(Q, tmp1, tmp2)
+        cur_Q = np.array(Q)
+
+        if np.max(np.abs(cur_Q - prev_Q)) < tolerance:
+            print 'CRF converged after {} iterations'.format(i + 1)
+            break
+
+        prev_Q = cur_Q
+
+    return np.array(Q, copy=False)